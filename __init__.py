@@ -1,19 +1,38 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import analysis
+from . import check
 from . import invoice
+from . import ir
+from . import log
 from . import purchase
+from . import rule
 from . import sale
 
 def register():
     Pool.register(
+        invoice.Invoice,
         invoice.InvoiceLine,
+        invoice.CurrencyRate,
+        invoice.ApplyDiscountStart,
+        rule.DiscountRule,
+        analysis.InvoiceDiscountAnalysis,
+        check.DiscountCheck,
+        check.DiscountIssue,
+        log.DiscountLog,
+        ir.Cron,
         module='account_invoice_discount', type_='model')
     Pool.register(
+        invoice.ApplyDiscount,
+        module='account_invoice_discount', type_='wizard')
+    Pool.register(
+        purchase.Purchase,
         purchase.PurchaseLine,
         module='account_invoice_discount', type_='model',
         depends=['purchase_discount'])
     Pool.register(
+        sale.Sale,
         sale.SaleLine,
         module='account_invoice_discount', type_='model',
         depends=['sale_discount'])
@@ -0,0 +1,158 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from sql import Literal, Null, With
+from sql.aggregate import Count, Min, Sum
+from sql.conditionals import Case, Coalesce, NullIf
+from sql.functions import Round
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.modules.currency.fields import Monetary
+
+from .invoice import discount_digits
+
+
+class InvoiceDiscountAnalysis(ModelSQL, ModelView):
+    __name__ = 'account.invoice.discount.analysis'
+
+    company = fields.Many2One('company.company', "Company")
+    type = fields.Selection([
+            ('out', "Customer"),
+            ('in', "Supplier"),
+            ], "Type")
+    party = fields.Many2One(
+        'party.party', "Party",
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    product = fields.Many2One(
+        'product.product', "Product",
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    period = fields.Many2One('account.period', "Period")
+    currency = fields.Many2One('currency.currency', "Currency")
+    number = fields.Integer("Number", help="The number of invoice lines.")
+    gross_amount = Monetary(
+        "Gross Amount", currency='currency', digits='currency',
+        help="The amount before discount.")
+    discount_amount = Monetary(
+        "Discount Amount", currency='currency', digits='currency')
+    discount_rate = fields.Numeric(
+        "Discount Rate", digits=discount_digits,
+        help="The discount amount relative to the gross amount.")
+    company_currency = fields.Many2One(
+        'currency.currency', "Company Currency")
+    company_gross_amount = Monetary(
+        "Company Gross Amount",
+        currency='company_currency', digits='company_currency',
+        help="The gross amount in the company currency.\n"
+        "Empty if there is no rate at the accounting date.")
+    company_discount_amount = Monetary(
+        "Company Discount Amount",
+        currency='company_currency', digits='company_currency',
+        help="The discount amount in the company currency.\n"
+        "Empty if there is no rate at the accounting date.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('period', 'DESC'))
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+        Move = pool.get('account.move')
+        line = Line.__table__()
+        invoice = Invoice.__table__()
+        move = Move.__table__()
+        currency = Currency.__table__()
+        company = Company.__table__()
+        company_currency = Currency.__table__()
+        currency_invoice = With(query=Currency.currency_rate_sql())
+        currency_company = With(query=Currency.currency_rate_sql())
+        context = Transaction().context
+
+        # Round per line like the untaxed amount of the invoice
+        def sum_amount(price, digits, rate=None):
+            amount = line.quantity * price
+            if rate is not None:
+                amount *= rate
+            return Sum(Round(cls.gross_amount.sql_cast(amount), digits))
+
+        gross_amount = sum_amount(line.base_price, currency.digits)
+        net_amount = sum_amount(line.unit_price, currency.digits)
+        discount_amount = gross_amount - net_amount
+
+        # The rates are joined per accounting date so the conversion costs no
+        # query per line
+        date = Coalesce(invoice.accounting_date, invoice.invoice_date)
+        rate = Case(
+            (invoice.currency == company.currency, Literal(1)),
+            else_=currency_company.rate / currency_invoice.rate)
+        company_gross_amount = sum_amount(
+            line.base_price, company_currency.digits, rate)
+        company_net_amount = sum_amount(
+            line.unit_price, company_currency.digits, rate)
+        company_discount_amount = company_gross_amount - company_net_amount
+
+        where = ((line.type == 'line')
+            & (line.base_price != Null)
+            & invoice.state.in_(['posted', 'paid']))
+        if context.get('company'):
+            where &= invoice.company == context['company']
+        return (line
+            .join(invoice, condition=line.invoice == invoice.id)
+            .join(move, condition=invoice.move == move.id)
+            .join(currency, condition=invoice.currency == currency.id)
+            .join(company, condition=invoice.company == company.id)
+            .join(company_currency,
+                condition=company.currency == company_currency.id)
+            .join(currency_invoice, 'LEFT',
+                condition=(invoice.currency == currency_invoice.currency)
+                & (currency_invoice.start_date <= date)
+                & ((currency_invoice.end_date == Null)
+                    | (currency_invoice.end_date > date)))
+            .join(currency_company, 'LEFT',
+                condition=(company.currency == currency_company.currency)
+                & (currency_company.start_date <= date)
+                & ((currency_company.end_date == Null)
+                    | (currency_company.end_date > date)))
+            .select(
+                Min(line.id).as_('id'),
+                invoice.company.as_('company'),
+                invoice.type.as_('type'),
+                invoice.party.as_('party'),
+                line.product.as_('product'),
+                move.period.as_('period'),
+                invoice.currency.as_('currency'),
+                Count(Literal('*')).as_('number'),
+                Round(cls.gross_amount.sql_cast(gross_amount),
+                    currency.digits).as_('gross_amount'),
+                Round(cls.discount_amount.sql_cast(discount_amount),
+                    currency.digits).as_('discount_amount'),
+                Round(cls.discount_rate.sql_cast(
+                        discount_amount / NullIf(gross_amount, 0)),
+                    discount_digits[1]).as_('discount_rate'),
+                company.currency.as_('company_currency'),
+                Round(cls.company_gross_amount.sql_cast(
+                        company_gross_amount),
+                    company_currency.digits).as_('company_gross_amount'),
+                Round(cls.company_discount_amount.sql_cast(
+                        company_discount_amount),
+                    company_currency.digits).as_('company_discount_amount'),
+                where=where,
+                group_by=[
+                    invoice.company, invoice.type, invoice.party,
+                    line.product, move.period, invoice.currency,
+                    currency.digits, company.currency,
+                    company_currency.digits],
+                with_=[currency_invoice, currency_company],
+                ))
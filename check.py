@@ -0,0 +1,217 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import datetime as dt
+import logging
+from decimal import Decimal
+
+from sql import Cast, Literal, Null
+from sql.aggregate import Max, Min
+from sql.conditionals import Coalesce
+from trytond import backend
+from trytond.config import config
+from trytond.model import Index, ModelSingleton, ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.tools import sqlite_apply_types
+from trytond.transaction import Transaction
+from trytond.modules.product import price_digits
+
+logger = logging.getLogger(__name__)
+
+CHECK_CHUNK_SIZE = config.getint(
+    'account_invoice_discount', 'check_chunk', default=100000)
+# The invoices modified by the transactions still running at the check are
+# checked again by the next one
+CHECK_OVERLAP = dt.timedelta(seconds=config.getint(
+        'account_invoice_discount', 'check_overlap', default=3600))
+
+
+def _config_rate(name):
+    value = config.get('account_invoice_discount', name, default=None)
+    return Decimal(value) if value is not None else None
+
+
+# The band of the expected discount rates
+CHECK_RATE_MIN = _config_rate('check_rate_min')
+CHECK_RATE_MAX = _config_rate('check_rate_max')
+
+
+def _numeric(column):
+    if backend.name == 'sqlite':
+        # Must be cast because Decimal is stored as bytes
+        column = Cast(column, 'REAL')
+    return column
+
+
+class DiscountCheck(ModelSingleton, ModelSQL):
+    __name__ = 'account.invoice.discount.check'
+
+    last_check = fields.Timestamp("Last Check", readonly=True)
+
+
+class DiscountIssue(ModelSQL, ModelView):
+    __name__ = 'account.invoice.discount.issue'
+
+    company = fields.Many2One('company.company', "Company", readonly=True)
+    line = fields.Many2One(
+        'account.invoice.line', "Invoice Line", required=True,
+        ondelete='CASCADE', readonly=True)
+    invoice = fields.Many2One('account.invoice', "Invoice", readonly=True)
+    kind = fields.Selection([
+            ('base_price', "Base Price differs from Origin"),
+            ('negative', "Negative Discount"),
+            ('rate', "Discount Rate out of Band"),
+            ], "Kind", required=True, readonly=True, sort=False)
+    base_price = fields.Numeric(
+        "Base Price", digits=price_digits, readonly=True)
+    unit_price = fields.Numeric(
+        "Unit Price", digits=price_digits, readonly=True)
+    origin_base_price = fields.Numeric(
+        "Origin Base Price", digits=price_digits, readonly=True,
+        states={
+            'invisible': Eval('kind') != 'base_price',
+            })
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.line, Index.Equality())))
+        cls._order.insert(0, ('line', 'DESC'))
+
+    @classmethod
+    def check(cls, chunk_size=None):
+        """Check the lines of the invoices posted or modified since the last
+        check and record their issues"""
+        pool = Pool()
+        Check = pool.get('account.invoice.discount.check')
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line = Line.__table__()
+        invoice = Invoice.__table__()
+
+        check = Check(1)
+        # Use the database time to compare with the stored timestamps
+        query = invoice.select(
+            Max(Coalesce(invoice.write_date, invoice.create_date)).as_('now'))
+        if backend.name == 'sqlite':
+            sqlite_apply_types(query, ['TIMESTAMP'])
+        cursor.execute(*query)
+        now, = cursor.fetchone()
+        where = invoice.state.in_(['posted', 'paid'])
+        if check.last_check:
+            where &= (
+                Coalesce(invoice.write_date, invoice.create_date)
+                > check.last_check)
+        cursor.execute(*line.join(invoice,
+                condition=line.invoice == invoice.id
+                ).select(Min(line.id), Max(line.id), where=where))
+        start, end = cursor.fetchone()
+        if start is not None:
+            cls.check_lines(
+                start, end + 1, chunk_size=chunk_size,
+                since=check.last_check)
+        if now is not None:
+            # As the issues of the lines are replaced, the overlap is safe
+            check.last_check = now - CHECK_OVERLAP
+            check.save()
+
+    @classmethod
+    def check_lines(cls, start, end, chunk_size=None, since=None):
+        """Record the issues of the lines of posted invoices with
+        start <= id < end and modified after since
+
+        The lines are checked against their origin sale or purchase line by
+        chunks of chunk_size ids.
+        Return the number of issues."""
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        line = Line.__table__()
+        invoice = Invoice.__table__()
+        chunk_size = chunk_size or CHECK_CHUNK_SIZE
+        invoice_where = invoice.state.in_(['posted', 'paid'])
+        if since:
+            invoice_where &= (
+                Coalesce(invoice.write_date, invoice.create_date) > since)
+
+        query = line.join(invoice, condition=line.invoice == invoice.id)
+        origin_base_prices = []
+        for name in ['sale.line', 'purchase.line']:
+            try:
+                Origin = pool.get(name)
+            except KeyError:
+                continue
+            if 'base_price' not in Origin._fields:
+                continue
+            origin = Origin.__table__()
+            query = query.join(origin, 'LEFT',
+                condition=line.origin.like(name + ',%')
+                & (origin.id == Line.origin.sql_id(line.origin, Origin)))
+            origin_base_prices.append(origin.base_price)
+        if len(origin_base_prices) > 1:
+            origin_base_price = Coalesce(*origin_base_prices)
+        elif origin_base_prices:
+            origin_base_price, = origin_base_prices
+        else:
+            origin_base_price = Literal(None)
+
+        rate = Line._discount_rate_column(line)
+        base_price_issue = (
+            (origin_base_price != Null)
+            & (_numeric(line.base_price) != _numeric(origin_base_price)))
+        negative_issue = (
+            _numeric(line.unit_price) > _numeric(line.base_price))
+        rate_issue = Literal(False)
+        if CHECK_RATE_MIN is not None:
+            rate_issue |= rate < float(CHECK_RATE_MIN)
+        if CHECK_RATE_MAX is not None:
+            rate_issue |= rate > float(CHECK_RATE_MAX)
+
+        count = 0
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            where = ((line.id >= chunk_start)
+                & (line.id < chunk_end)
+                & (line.type == 'line')
+                & (line.base_price != Null)
+                & (line.unit_price != Null)
+                & invoice_where)
+            cursor.execute(*table.delete(
+                    where=table.line.in_(
+                        query.select(line.id, where=where))))
+            cursor.execute(*query.select(
+                    invoice.company, line.id, invoice.id,
+                    line.base_price, line.unit_price, origin_base_price,
+                    base_price_issue, negative_issue, rate_issue,
+                    where=where
+                    & (base_price_issue | negative_issue | rate_issue)))
+            to_create = []
+            for (company, line_id, invoice_id, base_price, unit_price,
+                    origin_price, *issues) in cursor:
+                for kind, issue in zip(
+                        ['base_price', 'negative', 'rate'], issues):
+                    if issue:
+                        to_create.append({
+                                'company': company,
+                                'line': line_id,
+                                'invoice': invoice_id,
+                                'kind': kind,
+                                'base_price': base_price,
+                                'unit_price': unit_price,
+                                'origin_base_price': (
+                                    origin_price if kind == 'base_price'
+                                    else None),
+                                })
+            cls.create(to_create)
+            count += len(to_create)
+            logger.info(
+                "discount issues: %d found up to line %d (%d%%)",
+                count, chunk_end - 1,
+                (chunk_end - start) * 100 // (end - start))
+        return count
@@ -0,0 +1,16 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.exceptions import UserError
+from trytond.model.exceptions import ValidationError
+
+
+class DiscountCascadeValidationError(ValidationError):
+    pass
+
+
+class DiscountApplyError(UserError):
+    pass
+
+
+class DiscountImportError(UserError):
+    pass
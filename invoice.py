@@ -1,11 +1,36 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from decimal import Decimal
-from trytond.model import fields
+import csv
+import json
+import logging
+import time
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from weakref import WeakKeyDictionary
+from sql import Cast, Null
+from sql.aggregate import Max, Min, Sum
+from sql.conditionals import Coalesce, NullIf
+from sql.functions import Round
+from trytond import backend
+from trytond.cache import LRUDict
+from trytond.config import config
+from trytond.i18n import gettext
+from trytond.model import Index, ModelView, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids, sqlite_apply_types
+from trytond.transaction import Transaction
+from trytond.wizard import Button, StateTransition, StateView, Wizard
 from trytond.modules.currency.fields import Monetary
-from trytond.modules.product import price_digits, round_price
+from trytond.modules.product import price_digits
+
+from .exceptions import (
+    DiscountApplyError, DiscountCascadeValidationError, DiscountImportError)
+from .profiling import profile
+
+logger = logging.getLogger(__name__)
 
 STATES = {
     'invisible': Eval('type') != 'line',
@@ -13,6 +38,209 @@ STATES = {
     'readonly': Eval('invoice_state') != 'draft',
     }
 
+DISCOUNT_TEXT_CACHE_SIZE = config.getint(
+    'account_invoice_discount', 'discount_text_cache', default=1024)
+EXPORT_CHUNK_SIZE = config.getint(
+    'account_invoice_discount', 'export_chunk', default=10000)
+EXPORT_COLUMNS = [
+    'id', 'invoice', 'quantity', 'base_price', 'unit_price',
+    'discount_rate', 'discount_amount', 'discount']
+BACKFILL_CHUNK_SIZE = config.getint(
+    'account_invoice_discount', 'backfill_chunk', default=100000)
+BACKFILL_ON_ACTIVATION = config.getboolean(
+    'account_invoice_discount', 'backfill_on_activation', default=True)
+QUEUE_CHUNK_SIZE = config.getint(
+    'account_invoice_discount', 'queue_chunk', default=1000)
+IMPORT_BATCH_SIZE = config.getint(
+    'account_invoice_discount', 'import_batch', default=1000)
+# Languages and formatted discounts are cached per transaction
+_discount_langs = WeakKeyDictionary()
+_discount_texts = WeakKeyDictionary()
+# The currency rates are cached per transaction and (currency, date)
+_currency_rates = WeakKeyDictionary()
+
+discount_digits = (16, 4)
+
+
+def _exponent(digits):
+    return Decimal(1) / 10 ** digits[1]
+
+
+def compute_discounts(prices):
+    """Return the discount rate and amount of each (base_price, unit_price)
+
+    The rates are rounded to the discount digits and the amounts with
+    round_price."""
+    rate_exp, price_exp = _exponent(discount_digits), _exponent(price_digits)
+    discounts = []
+    for base_price, unit_price in prices:
+        if unit_price is None or base_price is None:
+            discounts.append((None, None))
+            continue
+        if base_price:
+            rate = (1 - unit_price / base_price).quantize(rate_exp)
+        else:
+            rate = None
+        discounts.append((rate, (base_price - unit_price).quantize(price_exp)))
+    return discounts
+
+
+def compute_unit_prices_from_rate(prices):
+    "Return the unit price of each (base_price, discount_rate)"
+    exp = _exponent(price_digits)
+    return [
+        (base_price * (1 - rate)).quantize(exp)
+        if base_price is not None and rate is not None else None
+        for base_price, rate in prices]
+
+
+def parse_discount_cascade(text):
+    """Return the rates of the cascaded discounts text like "10+5+2"
+
+    Raise ValueError if the text is not percentages separated by "+"."""
+    rates = []
+    for percent in text.split('+'):
+        try:
+            rate = Decimal(percent.strip()) / 100
+        except InvalidOperation:
+            raise ValueError(text)
+        if not 0 <= rate <= 1:
+            raise ValueError(text)
+        rates.append(rate)
+    return rates
+
+
+def compute_unit_prices_from_cascade(prices):
+    "Return the unit price of each (base_price, discount rates)"
+    exp = _exponent(price_digits)
+    unit_prices = []
+    for base_price, rates in prices:
+        if base_price is None:
+            unit_prices.append(None)
+            continue
+        # Round only the final price to not accumulate rounding errors
+        for rate in rates:
+            base_price *= 1 - rate
+        unit_prices.append(base_price.quantize(exp))
+    return unit_prices
+
+
+def compute_unit_prices_from_amount(prices):
+    "Return the unit price of each (base_price, discount_amount)"
+    exp = _exponent(price_digits)
+    return [
+        (base_price - amount).quantize(exp)
+        if base_price is not None and amount is not None else None
+        for base_price, amount in prices]
+
+
+def _order_discount_amounts(name):
+    def order(cls, tables):
+        table, _ = tables[None]
+        if 'discount_amounts' not in tables:
+            amounts = cls._discount_amounts_query(cls.__table__())
+            tables['discount_amounts'] = {
+                None: (amounts, amounts.invoice == table.id),
+                }
+        amounts, _ = tables['discount_amounts'][None]
+        return [getattr(amounts, name)]
+    return classmethod(order)
+
+
+class Invoice(metaclass=PoolMeta):
+    __name__ = 'account.invoice'
+
+    gross_amount = fields.Function(Monetary(
+            "Gross Amount", currency='currency', digits='currency',
+            help="The untaxed amount before discount."),
+        'get_discount_amounts', searcher='search_discount_amounts')
+    discount_amount = fields.Function(Monetary(
+            "Discount Amount", currency='currency', digits='currency'),
+        'get_discount_amounts', searcher='search_discount_amounts')
+
+    @classmethod
+    def create(cls, vlist):
+        # The taxes of the created lines are updated by on_modification
+        with Transaction().set_context(discount_update_taxes=False):
+            invoices = super().create(vlist)
+        return cls.browse(invoices)
+
+    @classmethod
+    def write(cls, *args):
+        # The taxes of the written lines are updated by on_modification
+        with Transaction().set_context(discount_update_taxes=False):
+            super().write(*args)
+
+    @classmethod
+    def _discount_amounts_query(cls, invoice):
+        """Return the query of the gross and discount amounts of the invoice
+        table"""
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Line = pool.get('account.invoice.line')
+        line = Line.__table__()
+        currency = Currency.__table__()
+        type_name = cls.gross_amount._field.sql_type().base
+
+        # Round per line like the untaxed amount
+        gross_amount = Coalesce(Sum(Round(
+                    (line.quantity * Coalesce(
+                            line.base_price, line.unit_price)
+                        ).cast(type_name),
+                    currency.digits)), 0)
+        untaxed_amount = Coalesce(Sum(Round(
+                    (line.quantity * line.unit_price).cast(type_name),
+                    currency.digits)), 0)
+        return (invoice
+            .join(currency, condition=invoice.currency == currency.id)
+            .join(line, 'LEFT',
+                condition=(line.invoice == invoice.id)
+                & (line.type == 'line'))
+            .select(
+                invoice.id.as_('invoice'),
+                gross_amount.as_('gross_amount'),
+                (gross_amount - untaxed_amount).as_('discount_amount'),
+                group_by=[invoice.id]))
+
+    @classmethod
+    def get_discount_amounts(cls, invoices, names):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        result = {n: {} for n in names}
+        for sub_invoices in grouped_slice(invoices):
+            sub_invoices = list(sub_invoices)
+            query = cls._discount_amounts_query(table)
+            query.where = reduce_ids(table.id, [i.id for i in sub_invoices])
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, 'NUMERIC', 'NUMERIC'])
+            cursor.execute(*query)
+            amounts = {i: (g, d) for i, g, d in cursor}
+            for invoice in sub_invoices:
+                for name, amount in zip(
+                        ['gross_amount', 'discount_amount'],
+                        amounts[invoice.id]):
+                    if name in result:
+                        # Float amount must be rounded to get the right
+                        # precision
+                        result[name][invoice.id] = invoice.currency.round(
+                            amount)
+        return result
+
+    @classmethod
+    def search_discount_amounts(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        # SQLite uses float for sum
+        if value is not None and backend.name == 'sqlite':
+            value = float(value)
+        amounts = cls._discount_amounts_query(cls.__table__())
+        return [('id', 'in', amounts.select(
+                    amounts.invoice,
+                    where=Operator(getattr(amounts, name), value)))]
+
+    order_gross_amount = _order_discount_amounts('gross_amount')
+    order_discount_amount = _order_discount_amounts('discount_amount')
+
 
 class InvoiceLine(metaclass=PoolMeta):
     __name__ = 'account.invoice.line'
@@ -25,26 +253,59 @@ class InvoiceLine(metaclass=PoolMeta):
             })
 
     discount_rate = fields.Function(fields.Numeric(
-            "Discount Rate", digits=(16, 4),
+            "Discount Rate", digits=discount_digits,
             states={
                 'invisible': Eval('type') != 'line',
                 'readonly': Eval('invoice_state') != 'draft',
                 }),
-        'on_change_with_discount_rate', setter='set_discount_rate')
+        'get_discounts', setter='set_discount_rate',
+        searcher='search_discount_rate')
     discount_amount = fields.Function(Monetary(
             "Discount Amount", currency='currency', digits=price_digits,
             states={
                 'invisible': Eval('type') != 'line',
                 'readonly': Eval('invoice_state') != 'draft',
                 }),
-        'on_change_with_discount_amount', setter='set_discount_amount')
+        'get_discounts', setter='set_discount_amount')
+
+    discount_cascade = fields.Char(
+        "Cascaded Discounts",
+        states={
+            'invisible': Eval('type') != 'line',
+            'readonly': Eval('invoice_state') != 'draft',
+            },
+        help="The successive discounts in percent separated by \"+\".\n"
+        "For example \"10+5+2\".")
 
     discount = fields.Function(fields.Char(
             "Discount",
             states={
                 'invisible': ~Eval('discount'),
                 }),
-        'on_change_with_discount')
+        'get_discounts')
+
+    company_currency = fields.Function(fields.Many2One(
+            'currency.currency', "Company Currency"),
+        'on_change_with_company_currency')
+    company_discount_amount = fields.Function(Monetary(
+            "Company Discount Amount",
+            currency='company_currency', digits='company_currency',
+            states={
+                'invisible': Eval('type') != 'line',
+                },
+            help="The total discount of the line in the company currency."),
+        'get_company_discount_amount')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (cls._discount_rate_column(t), Index.Range())))
+        cls.__rpc__.update({
+                'update_discount_taxes': RPC(
+                    readonly=False, instantiate=0),
+                })
 
     @classmethod
     def __register__(cls, module_name):
@@ -52,82 +313,784 @@ class InvoiceLine(metaclass=PoolMeta):
         table = cls.__table_handler__(module_name)
         if table.column_exist('gross_unit_price') and not table.column_exist('base_price'):
             table.column_rename('gross_unit_price', 'base_price')
+        # The lines existing before the installation have no base price
+        backfill = not table.column_exist('base_price')
         super().__register__(module_name)
+        if backfill:
+            if BACKFILL_ON_ACTIVATION:
+                cls.backfill_base_price()
+            else:
+                logger.warning(
+                    "base price not filled on activation, run "
+                    "backfill_base_price(start, end, commit=True) "
+                    "of account.invoice.line by ranges of ids")
+
+    @classmethod
+    def backfill_base_price(
+            cls, start=None, end=None, chunk_size=None, commit=False):
+        """Fill the missing base price of the lines with start <= id < end
+
+        The base price is the one of the origin sale or purchase line if any
+        or the unit price. The lines are updated by ranges of chunk_size ids
+        and each range is committed if commit is set, so distinct ranges can
+        be filled by parallel workers.
+        Return the number of lines updated."""
+        pool = Pool()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line = cls.__table__()
+        chunk_size = chunk_size or BACKFILL_CHUNK_SIZE
+
+        if start is None or end is None:
+            cursor.execute(*line.select(Min(line.id), Max(line.id)))
+            min_id, max_id = cursor.fetchone()
+            if min_id is None:
+                return 0
+            if start is None:
+                start = min_id
+            if end is None:
+                end = max_id + 1
+
+        base_prices = []
+        for name in ['sale.line', 'purchase.line']:
+            try:
+                Origin = pool.get(name)
+            except KeyError:
+                continue
+            if 'base_price' not in Origin._fields:
+                continue
+            origin = Origin.__table__()
+            base_prices.append(origin.select(
+                    origin.base_price,
+                    where=line.origin.like(name + ',%')
+                    & (origin.id == cls.origin.sql_id(line.origin, Origin))))
+        if base_prices:
+            base_price = Coalesce(*base_prices, line.unit_price)
+        else:
+            base_price = line.unit_price
+
+        updated = 0
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            cursor.execute(*line.update(
+                    [line.base_price], [base_price],
+                    where=(line.id >= chunk_start)
+                    & (line.id < chunk_end)
+                    & (line.type == 'line')
+                    & (line.base_price == Null)
+                    & (line.unit_price != Null)))
+            updated += cursor.rowcount
+            if commit:
+                transaction.commit()
+            logger.info(
+                "base price filled on %d lines up to id %d (%d%%)",
+                updated, chunk_end - 1,
+                (chunk_end - start) * 100 // (end - start))
+        return updated
 
-    @fields.depends(methods=['on_change_with_discount_rate',
-            'on_change_with_discount_amount', 'on_change_with_discount'])
+    @fields.depends(methods=['_set_discounts'])
     def on_change_product(self):
         super().on_change_product()
         if self.product:
-            self.discount_rate = self.on_change_with_discount_rate()
-            self.discount_amount = self.on_change_with_discount_amount()
-            self.discount = self.on_change_with_discount()
+            self._set_discounts()
+
+    @fields.depends('base_price', 'unit_price', 'currency')
+    def _set_discounts(self, rate=True, amount=True):
+        "Set the discount fields computed from the prices at once"
+        (discount_rate, discount_amount), = compute_discounts(
+            [(self.base_price, self.unit_price)])
+        if rate:
+            self.discount_rate = discount_rate
+        if amount:
+            self.discount_amount = discount_amount
+        self.discount = self._get_discount_text(
+            discount_rate, discount_amount, self.currency,
+            self._get_discount_lang())
 
     @fields.depends('unit_price', 'base_price')
+    @profile('account.invoice.line.on_change_with_discount_rate')
     def on_change_with_discount_rate(self, name=None):
-        if self.unit_price is None or not self.base_price:
-            return
-        rate = 1 - self.unit_price / self.base_price
-        return rate.quantize(
-            Decimal(1) / 10 ** self.__class__.discount_rate.digits[1])
+        (rate, _), = compute_discounts([(self.base_price, self.unit_price)])
+        return rate
 
     @fields.depends('base_price', 'discount_rate',
-        methods=['on_change_with_discount_amount', 'on_change_with_discount',
-            'on_change_with_amount'])
+        methods=['_set_discounts', 'on_change_with_amount'])
+    @profile('account.invoice.line.on_change_discount_rate')
     def on_change_discount_rate(self):
         if self.base_price is not None and self.discount_rate is not None:
-            self.unit_price = round_price(
-                self.base_price * (1 - self.discount_rate))
-            self.discount_amount = self.on_change_with_discount_amount()
-            self.discount = self.on_change_with_discount()
+            self.unit_price, = compute_unit_prices_from_rate(
+                [(self.base_price, self.discount_rate)])
+            self.discount_cascade = None
+            self._set_discounts(rate=False)
             self.amount = self.on_change_with_amount()
 
     @classmethod
+    @profile('account.invoice.line.set_discount_rate')
     def set_discount_rate(cls, lines, name, value):
-        pass
+        if value is None:
+            return
+        # Keep the unit price when the rate is the one it already has
+        lines = [l for l, (rate, _) in zip(lines, compute_discounts(
+                    (l.base_price, l.unit_price) for l in lines))
+            if l.base_price is not None and rate != value]
+        unit_prices = compute_unit_prices_from_rate(
+            (l.base_price, value) for l in lines)
+        cls.update_discount_taxes(cls._write_prices({
+                    l: (l.base_price, u) for l, u in zip(lines, unit_prices)}))
+
+    @classmethod
+    def _write_prices(cls, prices):
+        """Write the base and unit prices grouped by value
+
+        Return the lines written."""
+        to_write = defaultdict(list)
+        for line, (base_price, unit_price) in prices.items():
+            values = {}
+            if line.base_price != base_price:
+                values['base_price'] = base_price
+            if line.unit_price != unit_price:
+                values['unit_price'] = unit_price
+                # The discount is no more the cascade
+                if line.discount_cascade:
+                    values['discount_cascade'] = None
+            if values:
+                to_write[tuple(sorted(values.items()))].append(line)
+        args, written = [], []
+        for values, lines in to_write.items():
+            args.extend((lines, dict(values)))
+            written.extend(lines)
+        if args:
+            cls.write(*args)
+        return written
+
+    @classmethod
+    def update_discount_taxes(cls, lines):
+        """Update the taxes of the invoices of the lines
+
+        The taxes are computed once per invoice whatever the number of lines.
+        It does nothing when the context has discount_update_taxes set to
+        False, so the caller can update them after several writes."""
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        if not Transaction().context.get('discount_update_taxes', True):
+            return
+        invoices = {l.invoice for l in lines
+            if l.invoice and l.invoice_state == 'draft'}
+        if invoices:
+            Invoice.update_taxes(list(invoices))
+
+    @classmethod
+    @profile('account.invoice.line.apply_discount')
+    def apply_discount(cls, lines, rate=None, amount=None):
+        "Apply the discount rate or amount to the draft lines"
+        cls.check_apply_discount(rate, amount)
+        lines = [l for l in lines
+            if l.type == 'line'
+            and l.invoice_state == 'draft'
+            and l.unit_price is not None]
+        base_prices = [
+            l.base_price if l.base_price is not None else l.unit_price
+            for l in lines]
+        if rate is not None:
+            unit_prices = compute_unit_prices_from_rate(
+                (b, rate) for b in base_prices)
+        else:
+            unit_prices = compute_unit_prices_from_amount(
+                (b, amount) for b in base_prices)
+        cls.update_discount_taxes(cls._write_prices(
+                dict(zip(lines, zip(base_prices, unit_prices)))))
+
+    @classmethod
+    def check_apply_discount(cls, rate, amount):
+        "Check that exactly one of the discount rate or amount is set"
+        if (rate is None) == (amount is None):
+            raise DiscountApplyError(gettext(
+                    'account_invoice_discount'
+                    '.msg_apply_discount_rate_or_amount'))
+
+    @classmethod
+    def _chunks_by_invoice(cls, lines, size):
+        "Yield lists of about size lines without splitting the invoices"
+        by_invoice = defaultdict(list)
+        for line in lines:
+            by_invoice[line.invoice.id if line.invoice else None].append(line)
+        chunk = []
+        for invoice in sorted(by_invoice, key=lambda i: (i is None, i)):
+            chunk.extend(by_invoice[invoice])
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    @classmethod
+    def queue_apply_discount(
+            cls, lines, rate=None, amount=None, chunk_size=None):
+        """Queue the application of the discount rate or amount to the lines
+
+        Each task applies the discount to the lines of whole invoices so the
+        chunks are committed independently and never lock the same invoice.
+        As apply_discount is idempotent, the tasks can be retried safely."""
+        cls.check_apply_discount(rate, amount)
+        chunk_size = chunk_size or QUEUE_CHUNK_SIZE
+        with Transaction().set_context(
+                queue_name='account_invoice_discount', queue_batch=False):
+            for chunk in cls._chunks_by_invoice(lines, chunk_size):
+                cls.__queue__.apply_discount(chunk, rate=rate, amount=amount)
+
+    @classmethod
+    def _discount_rate_column(cls, table):
+        unit_price, base_price = table.unit_price, table.base_price
+        if backend.name == 'sqlite':
+            # Must be cast because Decimal is stored as bytes
+            unit_price = Cast(unit_price, 'REAL')
+            base_price = Cast(base_price, 'REAL')
+        # Round as the getter to search and order on the displayed rate
+        return Round(
+            (base_price - unit_price) / NullIf(base_price, 0),
+            discount_digits[1])
+
+    @classmethod
+    def search_discount_rate(cls, name, clause):
+        table = cls.__table__()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        value = cls.discount_rate._field._domain_value(operator, value)
+        query = table.select(table.id,
+            where=Operator(cls._discount_rate_column(table), value))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def order_discount_rate(cls, tables):
+        table, _ = tables[None]
+        return [cls._discount_rate_column(table)]
 
     @fields.depends('unit_price', 'base_price')
+    @profile('account.invoice.line.on_change_with_discount_amount')
     def on_change_with_discount_amount(self, name=None):
-        if self.unit_price is None or self.base_price is None:
-            return
-        return round_price(self.base_price - self.unit_price)
+        (_, amount), = compute_discounts([(self.base_price, self.unit_price)])
+        return amount
 
-    @fields.depends(
-        'base_price', 'discount_amount',
-        methods=['on_change_with_discount_rate', 'on_change_with_discount',
-            'on_change_with_amount'])
+    @fields.depends('base_price', 'discount_amount',
+        methods=['_set_discounts', 'on_change_with_amount'])
+    @profile('account.invoice.line.on_change_discount_amount')
     def on_change_discount_amount(self):
         if self.base_price is not None and self.discount_amount is not None:
-            self.unit_price = round_price(
-                self.base_price - self.discount_amount)
-            self.discount_rate = self.on_change_with_discount_rate()
-            self.discount = self.on_change_with_discount()
+            self.unit_price, = compute_unit_prices_from_amount(
+                [(self.base_price, self.discount_amount)])
+            self.discount_cascade = None
+            self._set_discounts(amount=False)
             self.amount = self.on_change_with_amount()
 
     @classmethod
+    @profile('account.invoice.line.set_discount_amount')
     def set_discount_amount(cls, lines, name, value):
-        pass
+        if value is None:
+            return
+        lines = [l for l, (_, amount) in zip(lines, compute_discounts(
+                    (l.base_price, l.unit_price) for l in lines))
+            if l.base_price is not None and amount != value]
+        unit_prices = compute_unit_prices_from_amount(
+            (l.base_price, value) for l in lines)
+        cls.update_discount_taxes(cls._write_prices({
+                    l: (l.base_price, u) for l, u in zip(lines, unit_prices)}))
+
+    @fields.depends('base_price', 'discount_cascade',
+        methods=['_set_discounts', 'on_change_with_amount'])
+    @profile('account.invoice.line.on_change_discount_cascade')
+    def on_change_discount_cascade(self):
+        if self.base_price is not None and self.discount_cascade:
+            try:
+                rates = parse_discount_cascade(self.discount_cascade)
+            except ValueError:
+                return
+            self.unit_price, = compute_unit_prices_from_cascade(
+                [(self.base_price, rates)])
+            self._set_discounts()
+            self.amount = self.on_change_with_amount()
+
+    @fields.depends('base_price', 'unit_price', 'discount_cascade')
+    def on_change_unit_price(self):
+        if hasattr(super(), 'on_change_unit_price'):
+            super().on_change_unit_price()
+        if self.discount_cascade:
+            try:
+                rates = parse_discount_cascade(self.discount_cascade)
+            except ValueError:
+                return
+            if (self.base_price is None
+                    or compute_unit_prices_from_cascade(
+                        [(self.base_price, rates)]) != [self.unit_price]):
+                self.discount_cascade = None
+
+    @classmethod
+    def preprocess_values(cls, mode, values):
+        values = super().preprocess_values(mode, values)
+        if (mode == 'create'
+                and values.get('discount_cascade')
+                and values.get('base_price') is not None
+                and values.get('unit_price') is None):
+            try:
+                rates = parse_discount_cascade(values['discount_cascade'])
+            except ValueError:
+                # validate_fields reports it
+                pass
+            else:
+                values['unit_price'], = compute_unit_prices_from_cascade(
+                    [(values['base_price'], rates)])
+        return values
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super().create(vlist)
+        cls.apply_discount_rules(lines)
+        return lines
+
+    @classmethod
+    def apply_discount_rules(cls, lines):
+        """Apply the discount rules to the draft lines without base price
+
+        The lines with an origin keep the price it gives them."""
+        pool = Pool()
+        Rule = pool.get('account.invoice.discount.rule')
+        lines = [l for l in lines
+            if l.type == 'line'
+            and l.invoice_state == 'draft'
+            and l.product
+            and l.origin is None
+            and l.unit_price is not None
+            and l.base_price is None]
+        if not lines:
+            return
+        prices = {}
+        for line, rate in zip(lines, Rule.get_discount_rates(lines)):
+            if rate is not None:
+                unit_price, = compute_unit_prices_from_rate(
+                    [(line.unit_price, rate)])
+                prices[line] = (line.unit_price, unit_price)
+        cls.update_discount_taxes(cls._write_prices(prices))
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Log = pool.get('account.invoice.discount.log')
+        actions = iter(args)
+        args, cascaded = [], []
+        cascade_rates = {}
+        for lines, values in zip(actions, actions):
+            # The unit price follows a new cascade or a new base price of the
+            # stored cascade
+            if 'unit_price' not in values and (
+                    values.get('discount_cascade')
+                    or ('base_price' in values
+                        and 'discount_cascade' not in values)):
+                # Group the lines by unit price to keep one write per value
+                to_write = defaultdict(list)
+                for line in lines:
+                    cascade = values.get(
+                        'discount_cascade', line.discount_cascade)
+                    base_price = values.get('base_price', line.base_price)
+                    unit_price = None
+                    if cascade and base_price is not None:
+                        if cascade not in cascade_rates:
+                            try:
+                                cascade_rates[cascade] = (
+                                    parse_discount_cascade(cascade))
+                            except ValueError:
+                                # Raised by the validation after the write
+                                cascade_rates[cascade] = None
+                        rates = cascade_rates[cascade]
+                        if rates is not None:
+                            unit_price, = compute_unit_prices_from_cascade(
+                                [(base_price, rates)])
+                            cascaded.append(line)
+                    to_write[unit_price].append(line)
+                for unit_price, lines in to_write.items():
+                    if unit_price is not None:
+                        args.extend(
+                            (lines, {**values, 'unit_price': unit_price}))
+                    else:
+                        args.extend((lines, values))
+            else:
+                args.extend((lines, values))
+        changes = cls._get_discount_changes(args)
+        super().write(*args)
+        Log.log_changes(changes)
+        cls.update_discount_taxes(cascaded)
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        Log = pool.get('account.invoice.discount.log')
+        Log.delete_lines(lines)
+        super().delete(lines)
+
+    @classmethod
+    def _get_discount_changes(cls, args):
+        "Return the changes of prices that the write arguments will make"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        actions = iter(args)
+        to_log = [(lines, values) for lines, values in zip(actions, actions)
+            if 'base_price' in values or 'unit_price' in values]
+        if not to_log:
+            return []
+        prices = {}
+        for sub_ids in grouped_slice(
+                {l.id for lines, _ in to_log for l in lines}):
+            query = table.select(
+                table.id, table.company, table.invoice,
+                table.base_price.as_('base_price'),
+                table.unit_price.as_('unit_price'),
+                where=reduce_ids(table.id, sub_ids))
+            if backend.name == 'sqlite':
+                sqlite_apply_types(
+                    query, [None, None, None, 'NUMERIC', 'NUMERIC'])
+            cursor.execute(*query)
+            prices.update((i, p) for i, *p in cursor)
+
+        changes = []
+        for lines, values in to_log:
+            for line in lines:
+                company, invoice, base_price, unit_price = prices[line.id]
+                new_base_price = values.get('base_price', base_price)
+                new_unit_price = values.get('unit_price', unit_price)
+                if (base_price, unit_price) != (
+                        new_base_price, new_unit_price):
+                    changes.append((
+                            company, invoice, line.id,
+                            base_price, new_base_price,
+                            unit_price, new_unit_price))
+                    prices[line.id] = (
+                        company, invoice, new_base_price, new_unit_price)
+        return changes
+
+    @classmethod
+    def validate_fields(cls, lines, field_names):
+        super().validate_fields(lines, field_names)
+        cls.check_discount_cascade(lines, field_names)
+
+    @classmethod
+    def check_discount_cascade(cls, lines, field_names=None):
+        if field_names and 'discount_cascade' not in field_names:
+            return
+        for line in lines:
+            if not line.discount_cascade:
+                continue
+            try:
+                parse_discount_cascade(line.discount_cascade)
+            except ValueError:
+                raise DiscountCascadeValidationError(gettext(
+                        'account_invoice_discount'
+                        '.msg_invalid_discount_cascade',
+                        cascade=line.discount_cascade,
+                        line=line.rec_name))
 
-    @fields.depends('invoice', 'currency', '_parent_invoice.currency',
-        methods=[
-            'on_change_with_discount_rate', 'on_change_with_discount_amount'])
+    @fields.depends('base_price', 'unit_price', 'currency')
+    @profile('account.invoice.line.on_change_with_discount')
     def on_change_with_discount(self, name=None):
+        (rate, amount), = compute_discounts(
+            [(self.base_price, self.unit_price)])
+        return self._get_discount_text(
+            rate, amount, self.currency, self._get_discount_lang())
+
+    @classmethod
+    def _get_discount_lang(cls):
         pool = Pool()
         Lang = pool.get('ir.lang')
-        lang = Lang.get()
-        rate = self.on_change_with_discount_rate()
+        transaction = Transaction()
+        langs = _discount_langs.setdefault(transaction, {})
+        code = transaction.language
+        if code not in langs:
+            langs[code] = Lang.get(code)
+        return langs[code]
+
+    @classmethod
+    def _get_discount_text(cls, rate, amount, currency, lang):
         if not rate or rate % Decimal('0.01'):
-            amount = self.on_change_with_discount_amount()
-            currency = self.invoice and self.invoice.currency or self.currency
-            if amount and currency:
-                return lang.currency(amount, currency, digits=price_digits[1])
+            if not amount or not currency:
+                return
+            key = ('amount', amount, currency.id, lang.code)
+        else:
+            key = ('rate', rate, lang.code)
+        texts = _discount_texts.get(Transaction())
+        if texts is None:
+            texts = _discount_texts[Transaction()] = LRUDict(
+                DISCOUNT_TEXT_CACHE_SIZE)
+        if key not in texts:
+            if key[0] == 'amount':
+                texts[key] = lang.currency(
+                    amount, currency, digits=price_digits[1])
+            else:
+                texts[key] = lang.format('%i', rate * 100) + '%'
+        return texts[key]
+
+    @classmethod
+    @profile('account.invoice.line.get_discounts')
+    def get_discounts(cls, lines, names):
+        lang = cls._get_discount_lang() if 'discount' in names else None
+        result = {n: {} for n in names}
+        discounts = compute_discounts(
+            (l.base_price, l.unit_price) for l in lines)
+        for line, (rate, amount) in zip(lines, discounts):
+            if 'discount_rate' in result:
+                result['discount_rate'][line.id] = rate
+            if 'discount_amount' in result:
+                result['discount_amount'][line.id] = amount
+            if 'discount' in result:
+                result['discount'][line.id] = cls._get_discount_text(
+                    rate, amount, line.currency, lang)
+        return result
+
+    @fields.depends('company')
+    def on_change_with_company_currency(self, name=None):
+        return self.company.currency if self.company else None
+
+    @classmethod
+    def _get_currency_rates(cls, keys):
+        """Return the rates of the currency at the date for the keys
+
+        The rates are cached per transaction and the missing ones are fetched
+        with a single query.
+        The rate is None if there is no rate for the currency at the date."""
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        rates = _currency_rates.setdefault(transaction, {})
+
+        missing = {k for k in keys if k not in rates}
+        if missing:
+            dates = {d for _, d in missing}
+            min_date, max_date = min(dates), max(dates)
+            currency_rate = Currency.currency_rate_sql()
+            query = currency_rate.select(
+                currency_rate.currency.as_('currency'),
+                currency_rate.rate.as_('rate'),
+                currency_rate.start_date.as_('start_date'),
+                currency_rate.end_date.as_('end_date'),
+                where=currency_rate.currency.in_(
+                    list({c for c, _ in missing}))
+                & (currency_rate.start_date <= max_date)
+                & ((currency_rate.end_date == Null)
+                    | (currency_rate.end_date > min_date)))
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, 'NUMERIC', 'DATE', 'DATE'])
+            cursor.execute(*query)
+            periods = defaultdict(list)
+            for currency, rate, start_date, end_date in cursor:
+                periods[currency].append((start_date, end_date, rate))
+            for currency, date in missing:
+                for start_date, end_date, rate in periods[currency]:
+                    if start_date <= date and (
+                            end_date is None or date < end_date):
+                        break
+                else:
+                    rate = None
+                rates[currency, date] = rate
+        return {k: rates[k] for k in keys}
+
+    @classmethod
+    def get_company_discount_amount(cls, lines, name):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        today = {}
+        amounts = {}
+        to_convert = []
+        for line, (_, amount) in zip(lines, compute_discounts(
+                    (l.base_price, l.unit_price) for l in lines)):
+            amounts[line.id] = None
+            if amount is None or not line.company:
+                continue
+            company_currency = line.company.currency
+            amount *= Decimal(str(line.quantity or 0))
+            if line.currency == company_currency:
+                amounts[line.id] = company_currency.round(amount)
+                continue
+            if line.invoice:
+                # Same date as the discount analysis
+                date = (
+                    line.invoice.accounting_date
+                    or line.invoice.currency_date)
+            else:
+                company = line.company.id
+                if company not in today:
+                    with Transaction().set_context(company=company):
+                        today[company] = Date.today()
+                date = today[company]
+            to_convert.append((line, amount, date))
+
+        rates = cls._get_currency_rates(
+            {(c.id, d) for l, _, d in to_convert
+                for c in [l.currency, l.company.currency]})
+        for line, amount, date in to_convert:
+            company_currency = line.company.currency
+            from_rate = rates[line.currency.id, date]
+            to_rate = rates[company_currency.id, date]
+            if from_rate and to_rate:
+                amounts[line.id] = company_currency.round(
+                    amount * to_rate / from_rate)
+        return amounts
+
+    @classmethod
+    def export_discounts(
+            cls, file, domain=None, format='csv', chunk_size=None):
+        """Write the discounts of the lines matching domain to file
+
+        The lines are read by chunks of chunk_size following the id order and
+        written as CSV rows or JSON objects of EXPORT_COLUMNS before reading
+        the next chunk, so the memory does not grow with the number of lines.
+        Return the number of lines written."""
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Invoice = pool.get('account.invoice')
+        assert format in {'csv', 'json'}
+        line = cls.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+        chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+        lang = cls._get_discount_lang()
+
+        # Filter always with the search to apply the record rules
+        where = (line.type == 'line') & line.id.in_(
+            cls.search(domain or [], query=True))
+        if format == 'csv':
+            writer = csv.writer(file)
+            writer.writerow(EXPORT_COLUMNS)
         else:
-            return lang.format('%i', rate * 100) + '%'
+            file.write('[')
+
+        def to_str(value):
+            return str(value) if value is not None else None
+
+        count, last_id = 0, 0
+        while True:
+            # Seek from the last id instead of an offset to read each chunk
+            # with the primary key index
+            cursor.execute(*line.join(invoice, 'LEFT',
+                    condition=line.invoice == invoice.id
+                    ).select(
+                    line.id, invoice.number, line.quantity,
+                    line.base_price, line.unit_price, line.currency,
+                    where=where & (line.id > last_id),
+                    order_by=[line.id.asc],
+                    limit=chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            currencies = {
+                c.id: c for c in Currency.browse({r[5] for r in rows if r[5]})}
+            discounts = compute_discounts((r[3], r[4]) for r in rows)
+            for row, (rate, amount) in zip(rows, discounts):
+                id_, number, quantity, base_price, unit_price, currency = row
+                text = cls._get_discount_text(
+                    rate, amount, currencies.get(currency), lang)
+                values = [
+                    id_, number, quantity, to_str(base_price),
+                    to_str(unit_price), to_str(rate), to_str(amount), text]
+                if format == 'csv':
+                    writer.writerow(values)
+                else:
+                    if count:
+                        file.write(',')
+                    file.write('\n')
+                    json.dump(dict(zip(EXPORT_COLUMNS, values)), file)
+                count += 1
+            last_id = rows[-1][0]
+        if format == 'json':
+            file.write('\n]\n')
+        return count
+
+    @classmethod
+    def import_lines(cls, invoice, rows, batch_size=None):
+        """Create lines on the draft invoice from the rows
+
+        Each row is a mapping with the product code, the quantity, the
+        base_price and the discount_rate or the discount_amount. The rows are
+        consumed by batches of batch_size so they can be a stream.
+        Return the number of lines created."""
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Product = pool.get('product.product')
+        if invoice.state != 'draft':
+            raise DiscountImportError(gettext(
+                    'account_invoice_discount.msg_import_invoice_not_draft',
+                    invoice=invoice.rec_name))
+        batch_size = batch_size or IMPORT_BATCH_SIZE
+        # The values of the lines of each product code
+        templates = {}
+        rows = iter(rows)
+        count, start = 0, time.perf_counter()
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            codes = {r['product'] for r in batch} - templates.keys()
+            if codes:
+                products = defaultdict(list)
+                for product in Product.search([('code', 'in', list(codes))]):
+                    products[product.code].append(product)
+                duplicates = {c for c, p in products.items() if len(p) > 1}
+                if duplicates:
+                    raise DiscountImportError(gettext(
+                            'account_invoice_discount'
+                            '.msg_import_product_duplicate',
+                            products=', '.join(sorted(duplicates))))
+                for code, (product,) in products.items():
+                    templates[code] = cls._import_values(invoice, product)
+                missing = codes - templates.keys()
+                if missing:
+                    raise DiscountImportError(gettext(
+                            'account_invoice_discount'
+                            '.msg_import_product_not_found',
+                            products=', '.join(sorted(missing))))
+            unit_prices = []
+            for row in batch:
+                if row.get('discount_rate') is not None:
+                    unit_price, = compute_unit_prices_from_rate(
+                        [(row['base_price'], row['discount_rate'])])
+                else:
+                    unit_price, = compute_unit_prices_from_amount(
+                        [(row['base_price'], row.get('discount_amount', 0))])
+                unit_prices.append(unit_price)
+            cls.create([{
+                        **templates[row['product']],
+                        'quantity': row['quantity'],
+                        'base_price': row['base_price'],
+                        'unit_price': unit_price,
+                        } for row, unit_price in zip(batch, unit_prices)])
+            count += len(batch)
+            duration = time.perf_counter() - start
+            logger.info(
+                "imported %d lines in %.1f s (%.0f lines/s)",
+                count, duration, count / duration if duration else 0)
+        if count:
+            Invoice.update_taxes([invoice])
+        return count
+
+    @classmethod
+    def _import_values(cls, invoice, product):
+        "Return the values of the imported lines of the product"
+        line = cls(
+            invoice=invoice, invoice_type=invoice.type,
+            party=invoice.party, currency=invoice.currency,
+            company=invoice.company, type='line', product=product)
+        line.on_change_product()
+        return {
+            'invoice': invoice.id,
+            'type': 'line',
+            'product': product.id,
+            'account': line.account.id if line.account else None,
+            'unit': line.unit.id if line.unit else None,
+            'taxes': [('add', [t.id for t in line.taxes])],
+            }
 
     def _credit(self):
         line = super()._credit()
         if self.base_price is not None:
             line.base_price = self.base_price
+        line.discount_cascade = self.discount_cascade
         return line
 
     @classmethod
@@ -137,3 +1100,86 @@ class InvoiceLine(metaclass=PoolMeta):
                 'invisible': Eval('type') != 'line',
                 }, ['type']),
             ]
+
+
+class CurrencyRate(metaclass=PoolMeta):
+    __name__ = 'currency.currency.rate'
+
+    @classmethod
+    def on_modification(cls, mode, rates, field_names=None):
+        super().on_modification(mode, rates, field_names=field_names)
+        _currency_rates.pop(Transaction(), None)
+
+
+class ApplyDiscountStart(ModelView):
+    __name__ = 'account.invoice.apply_discount.start'
+
+    discount_rate = fields.Numeric(
+        "Discount Rate", digits=discount_digits,
+        states={
+            'required': Eval('discount_amount', None) == None,
+            'readonly': Eval('discount_amount', None) != None,
+            })
+    discount_amount = fields.Numeric(
+        "Discount Amount", digits=price_digits,
+        states={
+            'required': Eval('discount_rate', None) == None,
+            'readonly': Eval('discount_rate', None) != None,
+            })
+    products = fields.Many2Many(
+        'product.product', None, None, "Products",
+        help="Apply only to lines of these products.\n"
+        "Leave empty for all products.")
+    categories = fields.Many2Many(
+        'product.category', None, None, "Categories",
+        help="Apply only to lines of products in these categories.\n"
+        "Leave empty for all categories.")
+    queue = fields.Boolean(
+        "Queue",
+        help="Apply the discount in background tasks by chunks of invoices.")
+
+
+class ApplyDiscount(Wizard):
+    __name__ = 'account.invoice.apply_discount'
+    start = StateView('account.invoice.apply_discount.start',
+        'account_invoice_discount.apply_discount_start_view_form', [
+            Button("Cancel", 'end', 'tryton-cancel'),
+            Button("Apply", 'apply', 'tryton-ok', default=True),
+            ])
+    apply = StateTransition()
+
+    def get_lines(self):
+        if self.model.__name__ == 'account.invoice':
+            lines = [l for i in self.records for l in i.lines]
+        else:
+            lines = self.records
+        return [l for l in lines if self.filter_line(l)]
+
+    def filter_line(self, line):
+        if self.start.products and line.product not in self.start.products:
+            return False
+        if self.start.categories:
+            if not line.product:
+                return False
+            template = line.product.template
+            categories = set(template.categories_all)
+            if getattr(template, 'account_category', None):
+                categories.add(template.account_category)
+            if not categories.intersection(self.start.categories):
+                return False
+        return True
+
+    def transition_apply(self):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        InvoiceLine.check_apply_discount(
+            self.start.discount_rate, self.start.discount_amount)
+        if self.start.queue:
+            apply_discount = InvoiceLine.queue_apply_discount
+        else:
+            apply_discount = InvoiceLine.apply_discount
+        apply_discount(
+            self.get_lines(),
+            rate=self.start.discount_rate,
+            amount=self.start.discount_amount)
+        return 'end'
@@ -0,0 +1,146 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from sql import Null
+from sql.functions import CurrentTimestamp
+
+from trytond.config import config
+from trytond.model import Index, ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from trytond.modules.product import price_digits
+
+LOG_FLUSH_SIZE = config.getint(
+    'account_invoice_discount', 'log_flush', default=10000)
+
+
+class DiscountLogDataManager:
+    "Store the discount logs of the transaction when it is committed"
+
+    def __init__(self):
+        self.queue = []
+
+    def __eq__(self, other):
+        if not isinstance(other, DiscountLogDataManager):
+            return NotImplemented
+        return True
+
+    def abort(self, trans):
+        self._finish()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pool = Pool()
+        Log = pool.get('account.invoice.discount.log')
+        Log.flush()
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self._finish()
+
+    def tpc_abort(self, trans):
+        self._finish()
+
+    def _finish(self):
+        self.queue = []
+
+
+class DiscountLog(ModelSQL, ModelView):
+    __name__ = 'account.invoice.discount.log'
+
+    company = fields.Many2One('company.company', "Company", readonly=True)
+    line = fields.Many2One(
+        'account.invoice.line', "Invoice Line",
+        ondelete='SET NULL', readonly=True)
+    line_id = fields.Integer("Invoice Line ID", readonly=True)
+    invoice_id = fields.Integer("Invoice ID", readonly=True)
+    old_base_price = fields.Numeric(
+        "Old Base Price", digits=price_digits, readonly=True)
+    new_base_price = fields.Numeric(
+        "New Base Price", digits=price_digits, readonly=True)
+    old_unit_price = fields.Numeric(
+        "Old Unit Price", digits=price_digits, readonly=True)
+    new_unit_price = fields.Numeric(
+        "New Unit Price", digits=price_digits, readonly=True)
+    user = fields.Many2One('res.user', "User", readonly=True)
+    date = fields.Timestamp("Date", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.line, Index.Equality()),
+                    (t.date, Index.Range(order='DESC'))),
+                Index(t, (t.line_id, Index.Equality())),
+                Index(t, (t.date, Index.Range(order='DESC'))),
+                })
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def _get_datamanager(cls):
+        return Transaction().join(DiscountLogDataManager())
+
+    @classmethod
+    def log_changes(cls, changes):
+        """Log the changes of prices of the invoice lines
+
+        changes is a list of tuples with company, invoice id, line id, old and
+        new base price, old and new unit price.
+        They are stored when the transaction is committed or when more than
+        log_flush changes are pending."""
+        if changes:
+            user = Transaction().user
+            datamanager = cls._get_datamanager()
+            # The line is kept twice to clear the first one if it is deleted
+            datamanager.queue.extend(
+                (company, invoice, line, line, *prices, user)
+                for company, invoice, line, *prices in changes)
+            if len(datamanager.queue) >= LOG_FLUSH_SIZE:
+                cls.flush()
+
+    @classmethod
+    def flush(cls):
+        "Store the pending logs of the transaction"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        datamanager = cls._get_datamanager()
+        queue, datamanager.queue = datamanager.queue, []
+        now = CurrentTimestamp()
+        # The logs are inserted without the ORM to keep the pricing cheap
+        for sub_queue in grouped_slice(queue):
+            cursor.execute(*table.insert(
+                    [table.company, table.invoice_id,
+                        table.line, table.line_id,
+                        table.old_base_price, table.new_base_price,
+                        table.old_unit_price, table.new_unit_price,
+                        table.user, table.date,
+                        table.create_uid, table.create_date],
+                    [[*c, now, c[-1], now] for c in sub_queue]))
+
+    @classmethod
+    def delete_lines(cls, lines):
+        """Detach the pending and stored logs from the invoice lines
+
+        It must be called before deleting the lines so the logs are kept with
+        the line id and they are not written by the ORM which requires the
+        access to write them."""
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        ids = {l.id for l in lines}
+        datamanager = cls._get_datamanager()
+        datamanager.queue = [
+            (c[0], c[1], None, *c[3:]) if c[2] in ids else c
+            for c in datamanager.queue]
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(
+                    [table.line], [Null],
+                    where=reduce_ids(table.line, sub_ids)))
@@ -0,0 +1,54 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import functools
+import logging
+import time
+from weakref import WeakKeyDictionary
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+PROFILE = config.getboolean(
+    'account_invoice_discount', 'profile', default=False)
+# The calls are counted and timed per transaction
+_stats = WeakKeyDictionary()
+
+
+def get_stats():
+    "Return the number of calls and the duration per name of the transaction"
+    return _stats.get(Transaction(), {})
+
+
+def _log_stats(stats):
+    for name, (count, duration) in sorted(stats.items()):
+        logger.info("%s: %d calls in %.6f s", name, count, duration)
+
+
+def profile(name):
+    """Decorator to count and time the calls of the function per transaction
+
+    It returns the function untouched when profile is not enabled in the
+    account_invoice_discount section of the configuration and the statistics
+    are logged at the end of the transaction."""
+    def decorator(func):
+        if not PROFILE:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                transaction = Transaction()
+                stats = _stats.get(transaction)
+                if stats is None:
+                    stats = _stats[transaction] = {}
+                    transaction.atexit(_log_stats, stats)
+                count, total = stats.get(name, (0, 0))
+                stats[name] = (count + 1, total + duration)
+        return wrapper
+    return decorator
@@ -0,0 +1,184 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from collections import defaultdict
+from weakref import WeakKeyDictionary
+
+from trytond.cache import Cache
+from trytond.model import (
+    DeactivableMixin, Index, ModelSQL, ModelView, fields, sequence_ordered)
+from trytond.pool import Pool
+from trytond.pyson import Eval, If
+from trytond.transaction import Transaction
+
+from .invoice import discount_digits
+
+# The indexes of the rules are built once per transaction and company
+_rule_indexes = WeakKeyDictionary()
+
+
+class DiscountRule(
+        sequence_ordered(), DeactivableMixin, ModelSQL, ModelView):
+    __name__ = 'account.invoice.discount.rule'
+
+    company = fields.Many2One('company.company', "Company", required=True)
+    invoice_type = fields.Selection([
+            (None, ""),
+            ('out', "Customer"),
+            ('in', "Supplier"),
+            ], "Type",
+        help="Apply only to invoices of this type.")
+    party = fields.Many2One(
+        'party.party', "Party",
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    product = fields.Many2One(
+        'product.product', "Product",
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    category = fields.Many2One(
+        'product.category', "Category",
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'},
+        help="Apply only to products in this category.")
+    min_quantity = fields.Float(
+        "Minimal Quantity",
+        help="Apply only to lines with at least this quantity.")
+    start_date = fields.Date(
+        "Start Date",
+        domain=[
+            If(Eval('start_date') & Eval('end_date'),
+                ('start_date', '<=', Eval('end_date')),
+                ()),
+            ])
+    end_date = fields.Date(
+        "End Date",
+        domain=[
+            If(Eval('start_date') & Eval('end_date'),
+                ('end_date', '>=', Eval('start_date')),
+                ()),
+            ])
+    discount_rate = fields.Numeric(
+        "Discount Rate", digits=discount_digits, required=True,
+        domain=[
+            ('discount_rate', '>=', 0),
+            ('discount_rate', '<=', 1),
+            ])
+
+    _rules_cache = Cache(__name__ + '.get_rules', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.company, Index.Equality())))
+
+    @classmethod
+    def default_company(cls):
+        return Transaction().context.get('company')
+
+    @classmethod
+    def on_modification(cls, mode, rules, field_names=None):
+        super().on_modification(mode, rules, field_names=field_names)
+        cls._rules_cache.clear()
+        _rule_indexes.pop(Transaction(), None)
+
+    @classmethod
+    def get_rules(cls, company):
+        "Return the active rules of the company as tuples in sequence order"
+        rules = cls._rules_cache.get(company)
+        if rules is None:
+            with Transaction().set_context(_check_access=False):
+                records = cls.search([
+                        ('company', '=', company),
+                        ])
+            rules = [(
+                    r.id, r.invoice_type,
+                    r.party.id if r.party else None,
+                    r.product.id if r.product else None,
+                    r.category.id if r.category else None,
+                    r.min_quantity, r.start_date, r.end_date,
+                    r.discount_rate) for r in records]
+            cls._rules_cache.set(company, rules)
+        return rules
+
+    @classmethod
+    def _get_index(cls, company):
+        "Return the rules of the company indexed by product and category"
+        indexes = _rule_indexes.setdefault(Transaction(), {})
+        if company not in indexes:
+            index = defaultdict(list)
+            for position, rule in enumerate(cls.get_rules(company)):
+                _, _, _, product, category, *_ = rule
+                if product is not None:
+                    key = ('product', product)
+                elif category is not None:
+                    key = ('category', category)
+                else:
+                    key = None
+                index[key].append((position, rule))
+            indexes[company] = index
+        return indexes[company]
+
+    @classmethod
+    def get_discount_rates(cls, lines):
+        """Return the discount rate of the first matching rule of each
+        invoice line or None"""
+        pool = Pool()
+        Date = pool.get('ir.date')
+        today = {}
+        rates = []
+        for line in lines:
+            company = line.company.id if line.company else None
+            if company is None or not line.product:
+                rates.append(None)
+                continue
+            index = cls._get_index(company)
+            if not index:
+                # Do not load the categories of the product for nothing
+                rates.append(None)
+                continue
+            keys = [('product', line.product.id), None]
+            categories = set(line.product.categories_all)
+            if line.product.account_category:
+                categories.add(line.product.account_category)
+            keys.extend(('category', c.id) for c in categories)
+            candidates = sorted(
+                (r for k in keys for r in index.get(k, [])),
+                key=lambda r: r[0])
+            if not candidates:
+                rates.append(None)
+                continue
+            invoice = line.invoice
+            party = invoice.party if invoice else line.party
+            date = invoice.invoice_date if invoice else None
+            if date is None:
+                if company not in today:
+                    with Transaction().set_context(company=company):
+                        today[company] = Date.today()
+                date = today[company]
+            for _, rule in candidates:
+                (_, invoice_type, rule_party, _, _, min_quantity,
+                    start_date, end_date, rate) = rule
+                if invoice_type and invoice_type != line.invoice_type:
+                    continue
+                if rule_party is not None and (
+                        not party or party.id != rule_party):
+                    continue
+                if (min_quantity is not None
+                        and (line.quantity or 0) < min_quantity):
+                    continue
+                if start_date and date < start_date:
+                    continue
+                if end_date and date > end_date:
+                    continue
+                rates.append(rate)
+                break
+            else:
+                rates.append(None)
+        return rates
@@ -1,12 +1,39 @@
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+
+from .profiling import profile
+
+
+class Sale(metaclass=PoolMeta):
+    __name__ = 'sale.sale'
+
+    def create_invoice(self):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        invoice = super().create_invoice()
+        if invoice:
+            SaleLine.set_invoice_lines_base_price(invoice.lines)
+        return invoice
 
 
 class SaleLine(metaclass=PoolMeta):
     __name__ = 'sale.line'
 
-    def get_invoice_line(self):
-        lines = super().get_invoice_line()
-        for line in lines:
-            line.base_price = self.base_price
-        return lines
-
+    @classmethod
+    @profile('sale.line.set_invoice_lines_base_price')
+    def set_invoice_lines_base_price(cls, invoice_lines):
+        """Set the base price and the cascaded discounts of the new invoice
+        lines from their sale line"""
+        prices = {}
+        for invoice_line in invoice_lines:
+            if invoice_line.id is not None and invoice_line.id >= 0:
+                continue
+            origin = invoice_line.origin
+            if not isinstance(origin, cls):
+                continue
+            if origin.id not in prices:
+                # The sale line may not store cascaded discounts
+                prices[origin.id] = (
+                    origin.base_price,
+                    getattr(origin, 'discount_cascade', None))
+            invoice_line.base_price, invoice_line.discount_cascade = (
+                prices[origin.id])
@@ -0,0 +1,277 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Benchmarks of the account_invoice_discount module
+
+They are not run by the test suite, run them with:
+
+    DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// \\
+        python -m trytond.modules.account_invoice_discount.tests.benchmark \\
+        1000 5000 10000 100000
+
+Each benchmark reports the wall time and the number of SQL queries. With
+--memory, it also reports the peak of memory allocated by Python but tracing
+the allocations slows down the execution.
+"""
+import argparse
+import logging
+import os
+import time
+import tracemalloc
+from decimal import Decimal
+
+from trytond.modules import get_modules
+from trytond.modules.account.tests import create_chart
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, with_transaction
+
+BACKEND_LOGGERS = [
+    'trytond.backend.postgresql.database',
+    'trytond.backend.sqlite.database',
+    ]
+
+
+class QueryCounter(logging.Handler):
+    "Count the queries logged by the backends"
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+    def install(self):
+        # Must be done before the connections are opened
+        for name in BACKEND_LOGGERS:
+            logger = logging.getLogger(name)
+            logger.setLevel(logging.DEBUG)
+            logger.propagate = False
+            logger.addHandler(self)
+
+
+query_counter = QueryCounter()
+trace_memory = False
+
+
+def create_product(company):
+    pool = Pool()
+    Account = pool.get('account.account')
+    Category = pool.get('product.category')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('company', '=', company.id),
+            ('closed', '!=', True),
+            ], limit=1)
+    expense, = Account.search([
+            ('type.expense', '=', True),
+            ('company', '=', company.id),
+            ('closed', '!=', True),
+            ], limit=1)
+    category = Category(
+        name="Account Category", accounting=True,
+        account_revenue=revenue, account_expense=expense)
+    category.save()
+    unit, = Uom.search([('name', '=', "Unit")])
+    template = Template(
+        name="Product", type='service', default_uom=unit,
+        list_price=Decimal('20'), account_category=category,
+        products=[{'suffix_code': "P"}])
+    if 'salable' in Template._fields:
+        template.salable = True
+        template.sale_uom = unit
+    if 'purchasable' in Template._fields:
+        template.purchasable = True
+        template.purchase_uom = unit
+    template.save()
+    product, = template.products
+    return product
+
+
+def setup():
+    pool = Pool()
+    Party = pool.get('party.party')
+
+    company = create_company()
+    with set_company(company):
+        create_chart(company)
+        party = Party(name="Party", addresses=[{}])
+        party.save()
+        product = create_product(company)
+    return company, party, product
+
+
+def create_invoice(
+        company, party, product, size, base_price=Decimal('10')):
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    Journal = pool.get('account.journal')
+
+    journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+    address, = party.addresses
+    invoice = Invoice(
+        type='out', company=company, currency=company.currency,
+        party=party, invoice_address=address, journal=journal,
+        account=party.account_receivable_used)
+    invoice.lines = [{
+            'type': 'line',
+            'company': company,
+            'currency': company.currency,
+            'product': product,
+            'account': product.account_revenue_used,
+            'unit': product.default_uom,
+            'quantity': 1,
+            'base_price': base_price,
+            'unit_price': Decimal('9'),
+            } for _ in range(size)]
+    invoice.save()
+    invoice, = Invoice.browse([invoice.id])
+    return invoice
+
+
+def bench(name, size, func, *args):
+    query_counter.count = 0
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    duration = time.perf_counter() - start
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory = '%10.1f MiB' % (peak / 2 ** 20)
+    else:
+        memory = ''
+    print("%-30s %8d lines %10.3f s %8d queries %s" % (
+            name, size, duration, query_counter.count, memory))
+
+
+@with_transaction()
+def bench_invoice(size):
+    pool = Pool()
+    DiscountRule = pool.get('account.invoice.discount.rule')
+    Invoice = pool.get('account.invoice')
+    InvoiceLine = pool.get('account.invoice.line')
+
+    company, party, product = setup()
+    with set_company(company):
+        invoice = create_invoice(company, party, product, size)
+        ids = [l.id for l in invoice.lines]
+
+        bench("read discounts", size, InvoiceLine.read, ids,
+            ['discount_rate', 'discount_amount', 'discount'])
+
+        def load_tree():
+            view = InvoiceLine.fields_view_get(view_type='tree')
+            InvoiceLine.search_read(
+                [('invoice', '=', invoice.id)],
+                fields_names=list(view['fields']))
+        bench("tree view", size, load_tree)
+
+        def export():
+            with open(os.devnull, 'w') as file:
+                InvoiceLine.export_discounts(
+                    file, domain=[('invoice', '=', invoice.id)])
+        bench("export discounts", size, export)
+
+        bench("write discount rate", size, InvoiceLine.write,
+            invoice.lines, {'discount_rate': Decimal('0.2')})
+        bench("apply discount", size, InvoiceLine.apply_discount,
+            InvoiceLine.browse(ids), Decimal('0.25'))
+
+        bench("credit", size, Invoice.credit, [invoice])
+
+        empty = create_invoice(company, party, product, 0)
+        bench("import lines", size, InvoiceLine.import_lines, empty, ({
+                    'product': "P",
+                    'quantity': 1,
+                    'base_price': Decimal('10'),
+                    'discount_rate': Decimal('0.1'),
+                    } for _ in range(size)))
+
+        DiscountRule.create([{
+                    'product': product.id,
+                    'min_quantity': 1,
+                    'discount_rate': Decimal('0.1'),
+                    }])
+        bench("create with rules", size,
+            create_invoice, company, party, product, size, None)
+
+
+@with_transaction()
+def bench_sale_invoice(size):
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+
+    company, party, product = setup()
+    with set_company(company):
+        address, = party.addresses
+        sale = Sale(
+            party=party, invoice_address=address, shipment_address=address,
+            invoice_method='order')
+        sale.lines = [{
+                'product': product,
+                'unit': product.default_uom,
+                'quantity': 1,
+                'base_price': Decimal('10'),
+                'unit_price': Decimal('9'),
+                } for _ in range(size)]
+        sale.save()
+        sale, = Sale.browse([sale.id])
+        bench("sale invoicing", size, Sale._process_invoice, [sale])
+
+
+@with_transaction()
+def bench_purchase_invoice(size):
+    pool = Pool()
+    Purchase = pool.get('purchase.purchase')
+
+    company, party, product = setup()
+    with set_company(company):
+        address, = party.addresses
+        purchase = Purchase(
+            party=party, invoice_address=address, invoice_method='order')
+        purchase.lines = [{
+                'product': product,
+                'unit': product.default_uom,
+                'quantity': 1,
+                'base_price': Decimal('10'),
+                'unit_price': Decimal('9'),
+                } for _ in range(size)]
+        purchase.save()
+        purchase, = Purchase.browse([purchase.id])
+        bench("purchase invoicing", size,
+            Purchase._process_invoice, [purchase])
+
+
+def main(sizes, memory=False):
+    global trace_memory
+    trace_memory = memory
+    query_counter.install()
+    modules = ['account_invoice_discount']
+    benchmarks = [bench_invoice]
+    available = get_modules()
+    if 'sale_discount' in available:
+        modules.append('sale_discount')
+        benchmarks.append(bench_sale_invoice)
+    if 'purchase_discount' in available:
+        modules.append('purchase_discount')
+        benchmarks.append(bench_purchase_invoice)
+    activate_module(modules)
+    for size in sizes:
+        for benchmark in benchmarks:
+            benchmark(size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'sizes', nargs='*', type=int, default=[1000, 5000, 10000, 100000],
+        help="number of lines")
+    parser.add_argument(
+        '--memory', action='store_true', help="report the peak of memory")
+    args = parser.parse_args()
+    main(args.sizes, memory=args.memory)
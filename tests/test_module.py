@@ -1,14 +1,695 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime as dt
+import io
+import json
+from decimal import Decimal
+from unittest.mock import Mock, PropertyMock, patch
+
+from trytond.modules.account.tests import create_chart
+from trytond.modules.account_invoice_discount import invoice as invoice_module
+from trytond.modules.account_invoice_discount import log as log_module
+from trytond.modules.account_invoice_discount import profiling
+from trytond.modules.account_invoice_discount.exceptions import (
+    DiscountApplyError, DiscountCascadeValidationError, DiscountImportError)
+from trytond.modules.account_invoice_discount.invoice import (
+    compute_discounts, compute_unit_prices_from_amount,
+    compute_unit_prices_from_cascade, compute_unit_prices_from_rate,
+    parse_discount_cascade)
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.currency.tests import (
+    add_currency_rate, create_currency)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+def create_lines(
+        company, base_prices, unit_price=Decimal('9'), currency=None):
+    "Create standalone customer lines with the base prices"
+    pool = Pool()
+    Account = pool.get('account.account')
+    InvoiceLine = pool.get('account.invoice.line')
+    Party = pool.get('party.party')
+
+    create_chart(company)
+    party = Party(name="Party")
+    party.save()
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('closed', '!=', True),
+            ], limit=1)
+    return InvoiceLine.create([{
+                'type': 'line',
+                'invoice_type': 'out',
+                'party': party.id,
+                'company': company.id,
+                'currency': (currency or company.currency).id,
+                'account': revenue.id,
+                'quantity': 1,
+                'base_price': base_price,
+                'unit_price': unit_price,
+                } for base_price in base_prices])
 
 
 class AccountInvoiceDiscountTestCase(CompanyTestMixin, ModuleTestCase):
     'Test AccountInvoiceDiscount module'
     module = 'account_invoice_discount'
 
+    def test_compute_discounts(self):
+        "Test compute discounts"
+        self.assertEqual(
+            compute_discounts([
+                    (Decimal('10'), Decimal('9')),
+                    (Decimal('3'), Decimal('2')),
+                    (Decimal('0'), Decimal('1')),
+                    (None, Decimal('1')),
+                    ]), [
+                (Decimal('0.1000'), Decimal('1.0000')),
+                (Decimal('0.3333'), Decimal('1.0000')),
+                (None, Decimal('-1.0000')),
+                (None, None),
+                ])
+
+    def test_compute_unit_prices(self):
+        "Test compute unit prices"
+        self.assertEqual(
+            compute_unit_prices_from_rate([
+                    (Decimal('10'), Decimal('0.1')),
+                    (Decimal('3'), Decimal('0.3333')),
+                    (None, Decimal('0.1')),
+                    ]),
+            [Decimal('9.0000'), Decimal('2.0001'), None])
+        self.assertEqual(
+            compute_unit_prices_from_amount([
+                    (Decimal('10'), Decimal('1')),
+                    (Decimal('10'), None),
+                    ]),
+            [Decimal('9.0000'), None])
+        self.assertEqual(
+            compute_unit_prices_from_cascade([
+                    (Decimal('100'), [Decimal('0.1'), Decimal('0.05')]),
+                    (Decimal('3'), [Decimal('0.3333')] * 3),
+                    (None, [Decimal('0.1')]),
+                    ]),
+            [Decimal('85.5000'), Decimal('0.8890'), None])
+
+    def test_parse_discount_cascade(self):
+        "Test parse discount cascade"
+        self.assertEqual(
+            parse_discount_cascade("10+5 + 2.5"),
+            [Decimal('0.1'), Decimal('0.05'), Decimal('0.025')])
+        for text in ["10+", "ten", "10+101", "-5"]:
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    parse_discount_cascade(text)
+
+    @with_transaction()
+    def test_discount_text_cache(self):
+        "Test discount text is formatted once per transaction"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        lang = Mock(code='en')
+        lang.format.return_value = '10'
+
+        for _ in range(2):
+            self.assertEqual(
+                InvoiceLine._get_discount_text(
+                    Decimal('0.1'), Decimal('1'), None, lang),
+                '10%')
+        self.assertEqual(lang.format.call_count, 1)
+        self.assertIsNone(
+            InvoiceLine._get_discount_text(
+                Decimal('0.1234'), Decimal('0'), None, lang))
+
+    @with_transaction()
+    def test_on_change_discount_depends(self):
+        "Test the fields sent for the discount on_change"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        self.assertEqual(
+            InvoiceLine._set_discounts.depends,
+            {'base_price', 'unit_price', 'currency'})
+        for name in ['discount_rate', 'discount_amount', 'discount']:
+            with self.subTest(name=name):
+                self.assertEqual(
+                    InvoiceLine._fields[name].on_change_with,
+                    {'base_price', 'unit_price', 'currency'}
+                    if name == 'discount' else {'base_price', 'unit_price'})
+
+    @with_transaction()
+    def test_on_change_discount_computations(self):
+        "Test the discount on_change compute the discounts once"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        currency = create_currency('cur')
+
+        for name, value, unit_price in [
+                ('discount_rate', Decimal('0.1'), Decimal('9.0000')),
+                ('discount_amount', Decimal('2'), Decimal('8.0000')),
+                ]:
+            with self.subTest(name=name):
+                line = InvoiceLine(
+                    type='line', quantity=2, base_price=Decimal('10'),
+                    currency=currency, invoice=None, invoice_type='out',
+                    taxes=[], taxes_deductible_rate=1)
+                setattr(line, name, value)
+                with patch.object(invoice_module, 'compute_discounts',
+                            wraps=compute_discounts) as compute, \
+                        patch.object(InvoiceLine, '_get_discount_text',
+                            return_value='text') as get_text:
+                    getattr(line, 'on_change_%s' % name)()
+                self.assertEqual(compute.call_count, 1)
+                self.assertEqual(get_text.call_count, 1)
+                self.assertEqual(line.unit_price, unit_price)
+                self.assertEqual(line.amount, unit_price * 2)
+                self.assertEqual(line.discount, 'text')
+
+    @with_transaction()
+    def test_discount_rules(self):
+        "Test discount rules are matched from an index built once"
+        pool = Pool()
+        Category = pool.get('product.category')
+        DiscountRule = pool.get('account.invoice.discount.rule')
+        InvoiceLine = pool.get('account.invoice.line')
+        Party = pool.get('party.party')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', "Unit")])
+            category = Category(name="Category")
+            category.save()
+            template = Template(
+                name="Product", default_uom=unit, categories=[category],
+                products=[{}])
+            template.save()
+            product, = template.products
+            party, other = Party.create([{'name': "Party"}, {'name': "Other"}])
+
+            def line(party, quantity, invoice_type='out'):
+                return InvoiceLine(
+                    company=company, product=product, party=party,
+                    quantity=quantity, invoice=None,
+                    invoice_type=invoice_type)
+
+            with patch.object(type(product), 'categories_all',
+                    new_callable=PropertyMock) as categories_all:
+                self.assertEqual(
+                    DiscountRule.get_discount_rates([line(party, 10)]),
+                    [None])
+                categories_all.assert_not_called()
+
+            DiscountRule.create([{
+                        'sequence': 10,
+                        'party': party.id,
+                        'min_quantity': 10,
+                        'discount_rate': Decimal('0.2'),
+                        }, {
+                        'sequence': 20,
+                        'category': category.id,
+                        'invoice_type': 'out',
+                        'discount_rate': Decimal('0.1'),
+                        }, {
+                        'sequence': 30,
+                        'product': product.id,
+                        'end_date': dt.date(2000, 1, 1),
+                        'discount_rate': Decimal('0.5'),
+                        }])
+
+            with patch.object(
+                    DiscountRule, 'search',
+                    wraps=DiscountRule.search) as search:
+                self.assertEqual(
+                    DiscountRule.get_discount_rates([
+                            line(party, 10), line(party, 5),
+                            line(other, 10), line(other, 10, 'in'),
+                            ]),
+                    [Decimal('0.2'), Decimal('0.1'), Decimal('0.1'), None])
+                DiscountRule.get_discount_rates([line(party, 10)])
+                self.assertEqual(search.call_count, 1)
+
+                rule, = DiscountRule.search([('sequence', '=', 10)])
+                rule.discount_rate = Decimal('0.3')
+                rule.save()
+                search.reset_mock()
+                self.assertEqual(
+                    DiscountRule.get_discount_rates([line(party, 10)]),
+                    [Decimal('0.3')])
+                self.assertEqual(search.call_count, 1)
+
+    @with_transaction()
+    def test_discount_rules_invoice_taxes(self):
+        "Test the taxes of an invoice created with rules are updated once"
+        pool = Pool()
+        Account = pool.get('account.account')
+        DiscountRule = pool.get('account.invoice.discount.rule')
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('closed', '!=', True),
+                    ], limit=1)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '!=', True),
+                    ], limit=1)
+            unit, = Uom.search([('name', '=', "Unit")])
+            template = Template(
+                name="Product", default_uom=unit, products=[{}])
+            template.save()
+            product, = template.products
+            party = Party(name="Party", addresses=[{}])
+            party.save()
+            address, = party.addresses
+            DiscountRule.create([{
+                        'product': product.id,
+                        'discount_rate': Decimal('0.1'),
+                        }])
+
+            with patch.object(Invoice, 'update_taxes',
+                    wraps=Invoice.update_taxes) as update_taxes:
+                invoice, = Invoice.create([{
+                            'type': 'out',
+                            'party': party.id,
+                            'invoice_address': address.id,
+                            'account': receivable.id,
+                            'lines': [('create', [{
+                                            'product': product.id,
+                                            'unit': unit.id,
+                                            'account': revenue.id,
+                                            'quantity': 1,
+                                            'unit_price': Decimal('10'),
+                                            }])],
+                            }])
+            line, = invoice.lines
+            self.assertEqual(line.unit_price, Decimal('9'))
+            self.assertEqual(update_taxes.call_count, 1)
+
+    @with_transaction()
+    def test_export_discounts(self):
+        "Test export discounts by chunks"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        company = create_company()
+        with set_company(company):
+            lines = create_lines(company, [Decimal('10'), None, Decimal('12')])
+
+            file = io.StringIO()
+            with patch.object(
+                    invoice_module, 'compute_discounts',
+                    wraps=compute_discounts) as compute:
+                self.assertEqual(
+                    InvoiceLine.export_discounts(file, chunk_size=2), 3)
+            self.assertEqual(compute.call_count, 2)
+            header, *rows = file.getvalue().splitlines()
+            self.assertEqual(header.split(','), invoice_module.EXPORT_COLUMNS)
+            self.assertEqual(rows[0].split(','), [
+                    str(lines[0].id), '', '1.0', '10', '9', '0.1000',
+                    '1.0000', '10%'])
+            self.assertEqual(rows[1].split(',')[3:], ['', '9', '', '', ''])
+
+            file = io.StringIO()
+            self.assertEqual(
+                InvoiceLine.export_discounts(
+                    file, domain=[('base_price', '>', Decimal('11'))],
+                    format='json'),
+                1)
+            row, = json.loads(file.getvalue())
+            self.assertEqual(row['id'], lines[2].id)
+            self.assertEqual(row['discount_rate'], '0.2500')
+
+    @with_transaction()
+    def test_export_discounts_record_rules(self):
+        "Test export discounts applies the record rules"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        User = pool.get('res.user')
+
+        company = create_company()
+        other_company = create_company(name="Other Company")
+        with set_company(company):
+            line, other = create_lines(company, [Decimal('10')] * 2)
+        # Move the line without the chart of accounts of the other company
+        table = InvoiceLine.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update(
+                [table.company], [other_company.id],
+                where=table.id == other.id))
+        user = User(Transaction().user)
+        user.companies = [company]
+        user.company = company
+        user.save()
+
+        with Transaction().set_context(
+                company=company.id, companies=[company.id],
+                _check_access=True):
+            file = io.StringIO()
+            self.assertEqual(
+                InvoiceLine.export_discounts(file, format='json'), 1)
+        row, = json.loads(file.getvalue())
+        self.assertEqual(row['id'], line.id)
+
+    @with_transaction()
+    def test_backfill_base_price(self):
+        "Test backfill base price by chunks"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        company = create_company()
+        with set_company(company):
+            lines = create_lines(company, [None, Decimal('10'), None, None])
+
+            self.assertEqual(
+                InvoiceLine.backfill_base_price(
+                    end=lines[2].id + 1, chunk_size=1),
+                2)
+            self.assertEqual(
+                [l['base_price'] for l in InvoiceLine.read(
+                        [l.id for l in lines], ['base_price'])],
+                [Decimal('9'), Decimal('10'), Decimal('9'), None])
+            self.assertEqual(InvoiceLine.backfill_base_price(), 1)
+
+    @with_transaction()
+    def test_profile(self):
+        "Test profile counts the calls per transaction only when enabled"
+        def func(value):
+            return value
+
+        with patch.object(profiling, 'PROFILE', False):
+            self.assertIs(profiling.profile('func')(func), func)
+        with patch.object(profiling, 'PROFILE', True):
+            profiled = profiling.profile('func')(func)
+        self.assertIsNot(profiled, func)
+        self.assertEqual(profiled(1), 1)
+        self.assertEqual(profiled(2), 2)
+        count, duration = profiling.get_stats()['func']
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(duration, 0)
+
+    @with_transaction()
+    def test_queue_apply_discount(self):
+        "Test queue apply discount by chunks of invoices"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        Queue = pool.get('ir.queue')
+
+        lines = [
+            InvoiceLine(id=id_, invoice=invoice)
+            for id_, invoice in [(1, 2), (2, 1), (3, 2), (4, 3), (5, None)]]
+        with patch.object(Queue, 'push') as push:
+            InvoiceLine.queue_apply_discount(
+                lines, rate=Decimal('0.1'), chunk_size=2)
+        self.assertEqual(
+            [(name, data['method'], data['instances'], data['kwargs'])
+                for (name, data), _ in push.call_args_list], [
+                ('account_invoice_discount', 'apply_discount', [2, 1, 3],
+                    {'rate': Decimal('0.1'), 'amount': None}),
+                ('account_invoice_discount', 'apply_discount', [4, 5],
+                    {'rate': Decimal('0.1'), 'amount': None}),
+                ])
+
+    @with_transaction()
+    def test_apply_discount_rate_or_amount(self):
+        "Test apply discount requires either a rate or an amount"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        for rate, amount in [(None, None), (Decimal('0.1'), Decimal('1'))]:
+            for apply_discount in [
+                    InvoiceLine.apply_discount,
+                    InvoiceLine.queue_apply_discount]:
+                with self.subTest(
+                        rate=rate, amount=amount,
+                        method=apply_discount.__name__):
+                    with self.assertRaises(DiscountApplyError):
+                        apply_discount([], rate=rate, amount=amount)
+
+    @with_transaction()
+    def test_import_lines(self):
+        "Test import lines by batches"
+        pool = Pool()
+        Account = pool.get('account.account')
+        Category = pool.get('product.category')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Journal = pool.get('account.journal')
+        Party = pool.get('party.party')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '!=', True),
+                    ], limit=1)
+            category = Category(
+                name="Category", accounting=True, account_revenue=revenue)
+            category.save()
+            unit, = Uom.search([('name', '=', "Unit")])
+            template = Template(
+                name="Product", default_uom=unit, account_category=category,
+                products=[{'suffix_code': "P1"}])
+            template.save()
+            party = Party(name="Party", addresses=[{}])
+            party.save()
+            journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+            invoice = Invoice(
+                type='out', party=party, invoice_address=party.addresses[0],
+                journal=journal, account=party.account_receivable_used)
+            invoice.save()
+
+            with patch.object(
+                    InvoiceLine, 'create', wraps=InvoiceLine.create) as create:
+                self.assertEqual(
+                    InvoiceLine.import_lines(invoice, ({
+                                'product': "P1",
+                                'quantity': 2,
+                                'base_price': Decimal('10'),
+                                'discount_rate': Decimal('0.1'),
+                                } for _ in range(4)), batch_size=3),
+                    4)
+            self.assertEqual(create.call_count, 2)
+            invoice = Invoice(invoice.id)
+            self.assertEqual(len(invoice.lines), 4)
+            line = invoice.lines[0]
+            self.assertEqual(line.account, revenue)
+            self.assertEqual(line.unit_price, Decimal('9.0000'))
+            self.assertEqual(invoice.untaxed_amount, Decimal('72.00'))
+
+            with self.assertRaises(DiscountImportError):
+                InvoiceLine.import_lines(invoice, [{
+                            'product': "P2",
+                            'quantity': 1,
+                            'base_price': Decimal('10'),
+                            'discount_amount': Decimal('1'),
+                            }])
+
+            with self.assertRaises(DiscountImportError):
+                InvoiceLine.import_lines(
+                    Invoice(invoice.id, state='posted'), [])
+
+            template, = Template.copy([template])
+            product, = template.products
+            product.suffix_code = "P1"
+            product.active = False
+            product.save()
+            with self.assertRaises(DiscountImportError), \
+                    Transaction().set_context(active_test=False):
+                InvoiceLine.import_lines(invoice, [{
+                            'product': "P1",
+                            'quantity': 1,
+                            'base_price': Decimal('10'),
+                            'discount_rate': Decimal('0.1'),
+                            }])
+
+    @with_transaction()
+    def test_discounts_computed_only_when_read(self):
+        "Test the discounts are computed only for the fields read"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        company = create_company()
+        with set_company(company):
+            lines = create_lines(company, [Decimal('10')] * 3)
+            ids = [l.id for l in lines]
+            view = InvoiceLine.fields_view_get(
+                view_type='tree', view_id=None)
+            fields_names = set(view['fields']) - {
+                'discount_rate', 'discount_amount', 'discount',
+                'company_discount_amount'}
+
+            def read(fields_names):
+                with patch.object(
+                            invoice_module, 'compute_discounts',
+                            wraps=compute_discounts) as compute, \
+                        patch.object(InvoiceLine, '_get_discount_lang',
+                            wraps=InvoiceLine._get_discount_lang) as lang, \
+                        patch.object(InvoiceLine, '_get_discount_text',
+                            wraps=InvoiceLine._get_discount_text) as text:
+                    InvoiceLine.read(ids, list(fields_names))
+                return compute.call_count, lang.call_count, text.call_count
+
+            # The optional discount columns are hidden
+            self.assertEqual(read(fields_names), (0, 0, 0))
+            # Only the numeric fields
+            self.assertEqual(
+                read(['discount_rate', 'discount_amount']), (1, 0, 0))
+            self.assertEqual(read(['discount']), (1, 1, 3))
+
+    @with_transaction()
+    def test_company_discount_amount(self):
+        "Test the company discount amounts use the cached rates"
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+
+        company = create_company()
+        currency = create_currency('cur')
+        add_currency_rate(currency, 2)
+        add_currency_rate(currency, 4, dt.date(2000, 1, 1))
+        with set_company(company), \
+                patch.object(Currency, 'currency_rate_sql',
+                    wraps=Currency.currency_rate_sql) as rate_sql:
+            lines = create_lines(
+                company, [Decimal('10'), None, Decimal('11')],
+                currency=currency)
+            lines += InvoiceLine.copy(lines[:1], default={
+                    'currency': company.currency.id,
+                    })
+
+            for _ in range(2):
+                self.assertEqual(
+                    [l.company_discount_amount
+                        for l in InvoiceLine.browse(lines)],
+                    [Decimal('0.25'), None, Decimal('0.50'), Decimal('1.00')])
+            self.assertEqual(rate_sql.call_count, 1)
+
+            add_currency_rate(currency, 5, dt.date.today())
+            self.assertEqual(
+                InvoiceLine(lines[0].id).company_discount_amount,
+                Decimal('0.20'))
+            self.assertEqual(rate_sql.call_count, 2)
+
+            # The rate is at the accounting date of the invoice
+            invoice = Invoice(
+                invoice_date=dt.date(1999, 6, 1),
+                currency_date=dt.date(1999, 6, 1),
+                accounting_date=dt.date(2000, 6, 1))
+            line = InvoiceLine(
+                id=lines[0].id, company=company, currency=currency,
+                invoice=invoice, quantity=1,
+                base_price=Decimal('10'), unit_price=Decimal('9'))
+            self.assertEqual(
+                InvoiceLine.get_company_discount_amount(
+                    [line], 'company_discount_amount'),
+                {line.id: Decimal('0.25')})
+
+    @with_transaction()
+    def test_discount_log(self):
+        "Test the changes of prices are logged when flushed"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        Log = pool.get('account.invoice.discount.log')
+
+        company = create_company()
+        with set_company(company):
+            line, other = create_lines(company, [Decimal('10')] * 2)
+            InvoiceLine.write(
+                [line, other], {'discount_rate': Decimal('0.2')})
+            InvoiceLine.write([line], {'description': "Test"})
+            InvoiceLine.write(
+                [line], {'base_price': Decimal('20')},
+                [other], {'unit_price': Decimal('8')})
+            self.assertEqual(Log.search([]), [])
+
+            Log.flush()
+            Log.flush()
+            logs = Log.search([], order=[('id', 'ASC')])
+            self.assertEqual([(
+                        l.line, l.old_base_price, l.new_base_price,
+                        l.old_unit_price, l.new_unit_price)
+                    for l in logs], [
+                    (line, 10, 10, 9, 8),
+                    (other, 10, 10, 9, 8),
+                    (line, 10, 20, 8, 8),
+                    ])
+            self.assertEqual({l.company for l in logs}, {company})
+            self.assertTrue(all(l.date for l in logs))
+
+    @with_transaction()
+    def test_discount_log_deleted_line(self):
+        "Test the logs of deleted lines are kept"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        Log = pool.get('account.invoice.discount.log')
+
+        company = create_company()
+        with set_company(company):
+            line, other = create_lines(company, [Decimal('10')] * 2)
+            InvoiceLine.write([line], {'discount_rate': Decimal('0.3')})
+            Log.flush()
+            InvoiceLine.write(
+                [line, other], {'discount_rate': Decimal('0.2')})
+            line_id = line.id
+            InvoiceLine.delete([line])
+            Log.flush()
+
+            logs = Log.search([('line_id', '=', line_id)])
+            self.assertEqual(len(logs), 2)
+            self.assertEqual({l.line for l in logs}, {None})
+            log, = Log.search([('line', '=', other.id)])
+            self.assertEqual(log.line_id, other.id)
+
+    @with_transaction()
+    def test_discount_log_failed_write(self):
+        "Test the changes of a failed write are not logged"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        Log = pool.get('account.invoice.discount.log')
+
+        company = create_company()
+        with set_company(company):
+            line, = create_lines(company, [Decimal('10')])
+            with self.assertRaises(DiscountCascadeValidationError):
+                InvoiceLine.write([line], {
+                        'unit_price': Decimal('5'),
+                        'discount_cascade': 'invalid',
+                        })
+            Log.flush()
+
+            self.assertEqual(Log.search([], count=True), 0)
+
+    @with_transaction()
+    def test_discount_log_flush_size(self):
+        "Test the pending logs are stored past the flush size"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        Log = pool.get('account.invoice.discount.log')
+
+        company = create_company()
+        with set_company(company):
+            lines = create_lines(company, [Decimal('10')] * 3)
+            with patch.object(log_module, 'LOG_FLUSH_SIZE', 2):
+                InvoiceLine.write(
+                    lines[:1], {'discount_rate': Decimal('0.2')})
+                self.assertEqual(Log.search([], count=True), 0)
+                InvoiceLine.write(
+                    lines[1:], {'discount_rate': Decimal('0.2')})
+                self.assertEqual(Log.search([], count=True), 3)
+
 
 del ModuleTestCase
@@ -1,6 +1,7 @@
 from trytond.modules.account_invoice.tests.tools import set_fiscalyear_invoice_sequences
 from trytond.modules.account.tests.tools import create_fiscalyear, create_chart, get_accounts, create_tax
 from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.model.exceptions import ValidationError
 from trytond.tests.tools import activate_modules
 from proteus import Model, Wizard
 from decimal import Decimal
@@ -95,6 +96,92 @@ class Test(unittest.TestCase):
         line.base_price = Decimal('10.0000')
         line.discount_rate = Decimal('0.1')
         self.assertEqual(line.unit_price, Decimal('9.0000'))
+        invoice.save()
+
+        # Write discounts on the server::
+        line, = invoice.lines
+        InvoiceLine.write([line.id], {'discount_rate': Decimal('0.2')}, {})
+        line.reload()
+        self.assertEqual(line.unit_price, Decimal('8.0000'))
+        invoice.reload()
+        self.assertEqual(invoice.tax_amount, Decimal('0.80'))
+        InvoiceLine.write([line.id], {'discount_rate': Decimal('0.3')},
+            {'discount_update_taxes': False})
+        invoice.reload()
+        self.assertEqual(invoice.tax_amount, Decimal('0.80'))
+        InvoiceLine.update_discount_taxes([line.id], {})
+        invoice.reload()
+        self.assertEqual(invoice.tax_amount, Decimal('0.70'))
+        InvoiceLine.write([line.id], {'discount_cascade': "10+5"}, {})
+        line.reload()
+        self.assertEqual(line.unit_price, Decimal('8.5500'))
+        invoice.reload()
+        self.assertEqual(invoice.tax_amount, Decimal('0.86'))
+        InvoiceLine.write([line.id], {'base_price': Decimal('20')}, {})
+        line.reload()
+        self.assertEqual(line.discount_cascade, "10+5")
+        self.assertEqual(line.unit_price, Decimal('17.1000'))
+        invoice.reload()
+        self.assertEqual(invoice.tax_amount, Decimal('1.71'))
+        InvoiceLine.write([line.id], {'base_price': Decimal('10')}, {})
+        line.reload()
+        self.assertEqual(line.unit_price, Decimal('8.5500'))
+        InvoiceLine.write([line.id], {'discount_amount': Decimal('1')}, {})
+        line.reload()
+        self.assertEqual(line.discount_cascade, None)
+        self.assertEqual(line.unit_price, Decimal('9.0000'))
+        invoice.reload()
+
+        # The changes of prices are logged::
+        DiscountLog = Model.get('account.invoice.discount.log')
+        logs = DiscountLog.find(
+            [('line', '=', line.id)], order=[('id', 'ASC')])
+        self.assertEqual(
+            [(l.old_unit_price, l.new_unit_price) for l in logs], [
+                (Decimal('9.0000'), Decimal('8.0000')),
+                (Decimal('8.0000'), Decimal('7.0000')),
+                (Decimal('7.0000'), Decimal('8.5500')),
+                (Decimal('8.5500'), Decimal('17.1000')),
+                (Decimal('17.1000'), Decimal('8.5500')),
+                (Decimal('8.5500'), Decimal('9.0000')),
+                ])
+
+        # Delete a re-priced line
+        other_invoice = Invoice(party=party)
+        other_line = other_invoice.lines.new()
+        other_line.account = revenue
+        other_line.quantity = 1
+        other_line.base_price = Decimal('10')
+        other_line.unit_price = Decimal('10')
+        other_invoice.save()
+        other_line, = other_invoice.lines
+        InvoiceLine.write(
+            [other_line.id], {'discount_rate': Decimal('0.1')}, {})
+        self.assertEqual(
+            len(DiscountLog.find([('line', '=', other_line.id)])), 1)
+        other_invoice.delete()
+        log, = DiscountLog.find([('line_id', '=', other_line.id)])
+        self.assertIsNone(log.line)
+        self.assertEqual(log.invoice_id, other_invoice.id)
+
+        # Apply a discount to the whole invoice::
+        apply_discount = Wizard('account.invoice.apply_discount', [invoice])
+        apply_discount.form.discount_rate = Decimal('0.2')
+        apply_discount.form.products.append(Model.get('product.product')(
+                product.id))
+        apply_discount.execute('apply')
+        invoice.reload()
+        line, = invoice.lines
+        self.assertEqual(line.unit_price, Decimal('8.0000'))
+        self.assertEqual(invoice.untaxed_amount, Decimal('8.00'))
+        self.assertEqual(invoice.tax_amount, Decimal('0.80'))
+
+        apply_discount = Wizard('account.invoice.apply_discount', [line])
+        apply_discount.form.discount_amount = Decimal('1')
+        apply_discount.execute('apply')
+        invoice.reload()
+        self.assertEqual(invoice.untaxed_amount, Decimal('9.00'))
+        self.assertEqual(invoice.tax_amount, Decimal('0.90'))
 
         # Post invoice and check again invoice totals and taxes::
         invoice.click('post')
@@ -102,6 +189,14 @@ class Test(unittest.TestCase):
         self.assertEqual(invoice.untaxed_amount, Decimal('9.00'))
         self.assertEqual(invoice.tax_amount, Decimal('0.90'))
         self.assertEqual(invoice.total_amount, Decimal('9.90'))
+        self.assertEqual(invoice.gross_amount, Decimal('10.00'))
+        self.assertEqual(invoice.discount_amount, Decimal('1.00'))
+        self.assertEqual(
+            Invoice.find([('discount_amount', '=', Decimal('1'))]), [invoice])
+        self.assertEqual(
+            Invoice.find([('gross_amount', '>', Decimal('10'))]), [])
+        self.assertEqual(
+            Invoice.find([], order=[('discount_amount', 'DESC')]), [invoice])
         receivable.reload()
         self.assertEqual(receivable.debit, Decimal('9.90'))
         self.assertEqual(receivable.credit, Decimal('0.00'))
@@ -110,6 +205,51 @@ class Test(unittest.TestCase):
         self.assertEqual(revenue.credit, Decimal('9.00'))
         line, = invoice.lines
 
+        # Analyse the discounts::
+        DiscountAnalysis = Model.get('account.invoice.discount.analysis')
+        analysis, = DiscountAnalysis.find([])
+        self.assertEqual(analysis.party, party)
+        self.assertEqual(analysis.product, product)
+        self.assertEqual(analysis.period, invoice.move.period)
+        self.assertEqual(analysis.number, 1)
+        self.assertEqual(analysis.gross_amount, Decimal('10.00'))
+        self.assertEqual(analysis.discount_amount, Decimal('1.00'))
+        self.assertEqual(analysis.discount_rate, Decimal('0.1'))
+        self.assertEqual(analysis.company_currency, company.currency)
+        self.assertEqual(analysis.company_gross_amount, Decimal('10.00'))
+        self.assertEqual(analysis.company_discount_amount, Decimal('1.00'))
+        self.assertEqual(line.discount_rate, Decimal('0.1'))
+        self.assertEqual(line.company_discount_amount, Decimal('1.00'))
+        self.assertEqual(line.discount_amount, Decimal('1.0000'))
+        self.assertEqual(line.discount, '10%')
+        self.assertEqual(
+            InvoiceLine.find([('discount_rate', '>=', Decimal('0.1'))]),
+            [line])
+        self.assertEqual(
+            InvoiceLine.find([('discount_rate', '>', Decimal('0.2'))]), [])
+        self.assertEqual(
+            InvoiceLine.find([], order=[('discount_rate', 'DESC')]), [line])
+
+        # Search on the rounded discount rate
+        third_invoice = Invoice(party=party)
+        third_line = third_invoice.lines.new()
+        third_line.account = revenue
+        third_line.quantity = 1
+        third_line.base_price = Decimal('3')
+        third_line.unit_price = Decimal('2')
+        third_invoice.save()
+        third_line, = third_invoice.lines
+        self.assertEqual(third_line.discount_rate, Decimal('0.3333'))
+        for operator, result in [
+                ('=', [third_line]),
+                ('<=', [third_line]),
+                ('>', []),
+                ]:
+            self.assertEqual(InvoiceLine.find([
+                        ('invoice', '=', third_invoice.id),
+                        ('discount_rate', operator, Decimal('0.3333')),
+                        ]), result)
+
         # Credit the invoice
         credit = Wizard('account.invoice.credit', [invoice])
         credit.form.with_refund = True
@@ -119,3 +259,104 @@ class Test(unittest.TestCase):
         credit_line, = credit_invoice.lines
         self.assertEqual(line.base_price, credit_line.base_price)
         self.assertEqual(line.unit_price, credit_line.unit_price)
+        self.assertEqual(line.discount_rate, credit_line.discount_rate)
+        self.assertEqual(line.discount_amount, credit_line.discount_amount)
+        self.assertEqual(line.discount, credit_line.discount)
+
+        # Use cascaded discounts and credit them
+        invoice = Invoice()
+        invoice.party = party
+        line = invoice.lines.new()
+        line.product = product
+        line.quantity = 1
+        line.base_price = Decimal('100')
+        line.discount_cascade = "10+5+2"
+        self.assertEqual(line.unit_price, Decimal('83.7900'))
+        self.assertEqual(line.discount_rate, Decimal('0.1621'))
+        line.discount_cascade = "10+"
+        with self.assertRaises(ValidationError):
+            invoice.save()
+        line.discount_cascade = "10+5+2"
+        invoice.save()
+        line, = invoice.lines
+        credit = Wizard('account.invoice.credit', [invoice])
+        credit.form.with_refund = False
+        credit.execute('credit')
+        credit_invoice, = Invoice.find([('lines.origin', '=', line)])
+        credit_line, = credit_invoice.lines
+        self.assertEqual(credit_line.discount_cascade, "10+5+2")
+        self.assertEqual(credit_line.unit_price, line.unit_price)
+
+        # Credit several invoices at once
+        invoices = []
+        for base_price, rate in [
+                (Decimal('10'), Decimal('0.25')),
+                (Decimal('8'), Decimal('0.05'))]:
+            invoice = Invoice()
+            invoice.party = party
+            line = invoice.lines.new()
+            line.product = product
+            line.quantity = 2
+            line.base_price = base_price
+            line.discount_rate = rate
+            invoice.save()
+            invoices.append(invoice)
+        credit = Wizard('account.invoice.credit', invoices)
+        credit.form.with_refund = False
+        credit.execute('credit')
+        for invoice in invoices:
+            line, = invoice.lines
+            credit_invoice, = Invoice.find([('lines.origin', '=', line)])
+            credit_line, = credit_invoice.lines
+            self.assertEqual(credit_line.quantity, -2)
+            self.assertEqual(line.base_price, credit_line.base_price)
+            self.assertEqual(line.unit_price, credit_line.unit_price)
+            self.assertEqual(line.discount_rate, credit_line.discount_rate)
+            self.assertEqual(
+                line.discount_amount, credit_line.discount_amount)
+            self.assertEqual(line.discount, credit_line.discount)
+
+        # Apply discount rules to new lines
+        DiscountRule = Model.get('account.invoice.discount.rule')
+        rule = DiscountRule()
+        rule.product = product
+        rule.min_quantity = 5
+        rule.discount_rate = Decimal('0.15')
+        rule.save()
+        invoice = Invoice()
+        invoice.party = party
+        for quantity in [5, 1]:
+            line = invoice.lines.new()
+            line.product = product
+            line.quantity = quantity
+            line.unit_price = Decimal('20')
+        invoice.save()
+        line5, line1 = sorted(invoice.lines, key=lambda l: -l.quantity)
+        self.assertEqual(line5.base_price, Decimal('20.0000'))
+        self.assertEqual(line5.unit_price, Decimal('17.0000'))
+        self.assertEqual(line5.discount_rate, Decimal('0.15'))
+        self.assertEqual(line1.base_price, None)
+        self.assertEqual(line1.unit_price, Decimal('20.0000'))
+        self.assertEqual(invoice.untaxed_amount, Decimal('105.00'))
+        self.assertEqual(invoice.tax_amount, Decimal('10.50'))
+
+        # Check the discounts of the posted invoices
+        invoice = Invoice()
+        invoice.party = party
+        line = invoice.lines.new()
+        line.product = product
+        line.quantity = 1
+        line.base_price = Decimal('10')
+        line.unit_price = Decimal('11')
+        invoice.click('post')
+        Cron = Model.get('ir.cron')
+        cron, = Cron.find([
+                ('method', '=', 'account.invoice.discount.issue|check'),
+                ])
+        cron.click('run_once')
+        DiscountIssue = Model.get('account.invoice.discount.issue')
+        issue, = DiscountIssue.find([])
+        self.assertEqual(issue.invoice, invoice)
+        self.assertEqual(issue.kind, 'negative')
+        cron.click('run_once')
+        self.assertEqual(len(DiscountIssue.find([])), 1)
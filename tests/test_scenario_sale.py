@@ -3,8 +3,10 @@ import unittest
 from proteus import Model
 from trytond.modules.company.tests.tools import create_company, get_company
 from trytond.modules.account.tests.tools import create_chart, get_accounts
+from trytond.pool import Pool
 from trytond.tests.tools import activate_modules
 from trytond.tests.test_tryton import drop_db
+from trytond.transaction import Transaction
 
 
 class Test(unittest.TestCase):
@@ -17,7 +19,8 @@ class Test(unittest.TestCase):
         super().tearDown()
 
     def test_account_invoice_discount(self):
-        activate_modules(['sale_discount', 'account_invoice_discount'])
+        config = activate_modules(
+            ['sale_discount', 'account_invoice_discount'])
 
         create_company()
         company = get_company()
@@ -81,3 +84,27 @@ class Test(unittest.TestCase):
         self.assertEqual(iline.discount_amount, Decimal('1.0000'))
         self.assertEqual(iline.discount, '10%')
 
+        # Create the invoice of a manual sale without processing it
+        sale = Sale()
+        sale.party = party
+        sale.invoice_method = 'manual'
+        line = sale.lines.new()
+        line.product = product
+        line.quantity = 1
+        line.base_price = Decimal('20.0000')
+        line.discount_rate = Decimal('0.25')
+        sale.click('quote')
+        sale.click('confirm')
+        self.assertEqual(sale.invoices, [])
+
+        with Transaction().start(
+                config.database_name, config.user, context=config.context):
+            pool = Pool()
+            Sale_ = pool.get('sale.sale')
+            with Transaction().set_context(_sale_manual_invoice=True):
+                invoice = Sale_(sale.id).create_invoice()
+            invoice.save()
+            iline, = invoice.lines
+            self.assertEqual(iline.base_price, Decimal('20.0000'))
+            self.assertEqual(iline.unit_price, Decimal('15.0000'))
+            self.assertEqual(iline.discount_rate, Decimal('0.25'))